@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the effect of py7file IOPolicy kernel hints on hashing.
+
+Hashes a large file cold with different policies and reports throughput and
+how much of the file stays in the page cache afterwards (Linux only)::
+
+    python bench_io_hints.py [size in MiB] [directory]
+"""
+import ctypes
+import ctypes.util
+import mmap
+import os
+import sys
+import tempfile
+import time
+
+import py7file
+from py7file import IOPolicy, Py7File
+
+POLICIES = (
+    ('no hints', IOPolicy(sequential=False)),
+    ('sequential', IOPolicy()),
+    ('sequential + readahead 8 MiB', IOPolicy(readahead=8 * 1024 * 1024)),
+    ('sequential + drop behind', IOPolicy(drop_behind=True)),
+)
+
+
+def resident_fraction(path):
+    """Fraction of the pages of path in the page cache or None."""
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                          ctypes.c_int, ctypes.c_int, ctypes.c_int64]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                             ctypes.c_char_p]
+    size = os.path.getsize(path)
+    pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            return None
+        try:
+            vec = ctypes.create_string_buffer(pages)
+            if libc.mincore(addr, size, vec) != 0:
+                return None
+            return sum(ord(c) & 1 for c in vec.raw) / float(pages)
+        finally:
+            libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+
+
+def evict(path):
+    """Drop path from the page cache."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        IOPolicy().advise(fd, 0, 0, py7file.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def main(size_mb=256, directory=None):
+    if py7file._fadvise is None:
+        print('posix_fadvise is not available, hints have no effect')
+    fd, path = tempfile.mkstemp(suffix='.bin', dir=directory)
+    try:
+        chunk = os.urandom(1024 * 1024)
+        with os.fdopen(fd, 'wb') as the_file:
+            for i in range(size_mb):
+                the_file.write(chunk)
+            the_file.flush()
+            os.fsync(the_file.fileno())
+        the_file = Py7File(path)
+        print('{0:<32} {1:>10} {2:>10}'.format('policy', 'MiB/s', 'cached'))
+        for name, policy in POLICIES:
+            evict(path)
+            start = time.time()
+            the_file.get_md5(io_policy=policy)
+            elapsed = time.time() - start
+            cached = resident_fraction(path)
+            print('{0:<32} {1:>10.1f} {2:>10}'.format(
+                name, size_mb / elapsed,
+                'n/a' if cached is None else '{0:.0%}'.format(cached)))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 256,
+         sys.argv[2] if len(sys.argv) > 2 else None)
@@ -11,7 +11,11 @@ Think: os.path, shutil, file, open, ... with convenient method based access.
 The Py7File class allows to do simple copy, move, backup, delete, unzip/rezip
 operations on files
 """
+import bz2
+from bisect import bisect_left, insort
 import codecs
+from collections import namedtuple
+import errno
 from glob import glob
 import gzip
 
@@ -19,11 +23,915 @@ import os
 import re
 import shutil
 import hashlib
+import json
 import mimetypes
-import string
+import posixpath
+import sqlite3
+import tempfile
+import stat
+import time
 import zipfile
-import filecmp
 import sys
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class FsyncBatch(object):
+
+    """
+    Collects files and directories that need to be flushed to disk and syncs
+    them all at once.
+
+    Pass an instance as ``durable`` argument to :meth:`Py7File.copy`,
+    :meth:`Py7File.move` or :meth:`Py7File.rezip` to defer the fsync calls of
+    many operations to a single :meth:`flush`. Each operation still replaces
+    its destination atomically but is only guaranteed to survive a crash after
+    the batch has been flushed. Used as a context manager the batch flushes on
+    exit::
+
+        with FsyncBatch() as batch:
+            for the_file in files:
+                the_file.backup(durable=batch)
+    """
+
+    def __init__(self):
+        self._files = set()
+        self._dirs = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def __len__(self):
+        return len(self._files) + len(self._dirs)
+
+    def add_file(self, path):
+        """Schedule file at path for fsync."""
+        self._files.add(os.path.abspath(path))
+
+    def add_dir(self, path):
+        """Schedule directory at path for fsync."""
+        self._dirs.add(os.path.abspath(path))
+
+    def flush(self):
+        """Fsync all scheduled files first and their directories after."""
+        files, self._files = self._files, set()
+        dirs, self._dirs = self._dirs, set()
+        for path in sorted(files):
+            if os.path.isfile(path):
+                _fsync_file(path)
+        for path in sorted(dirs):
+            _fsync_dir(path)
+
+
+def _fsync_file(path):
+    """Flush file contents at path to disk."""
+    fd = os.open(path, os.O_RDWR if os.name == 'nt' else os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_dir(path):
+    """Flush directory entries at path to disk (where supported)."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Windows can not open directories
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        # Some filesystems do not support fsync on directories
+        if e.errno not in (errno.EINVAL, errno.EBADF, errno.ENOTSUP):
+            raise
+    finally:
+        os.close(fd)
+
+
+def _mktemp(dest):
+    """Create an empty hidden temp file next to dest and return its path."""
+    location, filename = os.path.split(os.path.abspath(dest))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + filename + '.',
+                                    suffix='.tmp', dir=location)
+    os.close(fd)
+    return tmp_path
+
+
+def _commit(tmp_path, dest, durable=False):
+    """Atomically replace dest with the completely written tmp_path.
+
+    :param durable: `False` for no fsync, `True` to fsync file and directory
+        immediately or a :class:`FsyncBatch` to defer the fsync calls.
+    """
+    if durable is True:
+        _fsync_file(tmp_path)
+    if os.name == 'nt' and os.path.exists(dest):
+        # os.rename does not overwrite on windows
+        os.remove(dest)
+    os.rename(tmp_path, dest)
+    if durable is True:
+        _fsync_dir(os.path.dirname(os.path.abspath(dest)))
+    elif isinstance(durable, FsyncBatch):
+        durable.add_file(dest)
+        durable.add_dir(os.path.dirname(os.path.abspath(dest)))
+
+
+def _discard(tmp_path):
+    """Remove a leftover temp file of a failed write."""
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+
+def _read_block_manifest(manifest, path, block_size):
+    """Load cached block digests of path from manifest.
+
+    :return: list of hex digests or None if the manifest is missing or stale.
+    """
+    try:
+        with open(manifest, 'rb') as manifest_file:
+            data = json.loads(manifest_file.read().decode('utf-8'))
+    except (IOError, ValueError):
+        return None
+    file_stat = os.stat(path)
+    if (data.get('block_size') != block_size or
+            data.get('size') != file_stat.st_size or
+            data.get('mtime_ns') != _mtime_ns(file_stat)):
+        return None
+    return data.get('digests')
+
+
+def _write_block_manifest(manifest, path, block_size, digests):
+    """Atomically store block digests of path together with its stat key."""
+    file_stat = os.stat(path)
+    data = {'block_size': block_size, 'size': file_stat.st_size,
+            'mtime_ns': _mtime_ns(file_stat), 'digests': digests}
+    tmp_path = _mktemp(manifest)
+    try:
+        with open(tmp_path, 'wb') as manifest_file:
+            manifest_file.write(json.dumps(data).encode('utf-8'))
+        _commit(tmp_path, manifest)
+    except:
+        _discard(tmp_path)
+        raise
+
+
+def _copy_segment(src, dst, size, chunk_size=1024 * 1024):
+    """Copy up to size bytes from src to dst (or nowhere if dst is None).
+
+    :return: MD5 hex digest and length of the copied data.
+    """
+    md5 = hashlib.md5()
+    length = 0
+    while length < size:
+        data = src.read(min(chunk_size, size - length))
+        if not data:
+            break
+        md5.update(data)
+        if dst is not None:
+            dst.write(data)
+        length += len(data)
+    return md5.hexdigest(), length
+
+
+def _mtime_ns(file_stat):
+    """Modification time of a stat result in integer nanoseconds."""
+    mtime_ns = getattr(file_stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(file_stat.st_mtime * 1000000000)
+    return mtime_ns
+
+
+def _walk_stats(root):
+    """Yield (relative path, lstat result) for all regular files below root.
+
+    Uses scandir where available to avoid a second stat call per directory
+    entry.
+    """
+    if scandir is None:
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    file_stat = os.lstat(path)
+                except OSError:
+                    continue
+                if stat.S_ISREG(file_stat.st_mode):
+                    yield os.path.relpath(path, root), file_stat
+        return
+    pending = ['']
+    while pending:
+        reldir = pending.pop()
+        try:
+            entries = list(scandir(os.path.join(root, reldir)))
+        except OSError:
+            continue
+        for entry in entries:
+            relpath = os.path.join(reldir, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(relpath)
+                elif entry.is_file(follow_symlinks=False):
+                    yield relpath, entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+
+# Linux values of the posix_fadvise advice constants
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+POSIX_FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 3)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+
+def _load_libc_hints():
+    """posix_fadvise and readahead functions or None where unavailable."""
+    fadvise = getattr(os, 'posix_fadvise', None)
+    readahead = None
+    if sys.platform.startswith('linux'):
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except (ImportError, OSError):
+            return fadvise, readahead
+        if fadvise is None and hasattr(libc, 'posix_fadvise64'):
+            libc.posix_fadvise64.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                             ctypes.c_int64, ctypes.c_int]
+
+            def fadvise(fd, offset, length, advice):
+                libc.posix_fadvise64(fd, offset, length, advice)
+        if hasattr(libc, 'readahead'):
+            libc.readahead.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                       ctypes.c_size_t]
+
+            def readahead(fd, offset, count):
+                libc.readahead(fd, offset, count)
+    return fadvise, readahead
+
+
+_fadvise, _readahead = _load_libc_hints()
+
+
+class IOPolicy(object):
+
+    """
+    Kernel hints for reading whole files front to back.
+
+    Hints are applied with posix_fadvise and readahead where the platform
+    offers them (natively or via libc on Linux) and silently skipped
+    elsewhere. Set :attr:`Py7File.io_policy` or
+    :attr:`Py7File.scan_io_policy` to change them globally or pass a policy
+    to a single call.
+
+    :param sequential: Advise sequential access, which makes the kernel
+        read ahead more aggressively.
+    :param willneed: Ask the kernel to prefetch the whole file on open.
+    :param readahead: Bytes to prefetch ahead of the read position or
+        `None` to leave readahead to the kernel.
+    :param drop_behind: Evict pages already read from the page cache, so
+        one-shot scans do not push hot data out of the cache.
+    """
+
+    #: Bytes read between evictions when dropping behind
+    drop_size = 8 * 1024 * 1024
+
+    def __init__(self, sequential=True, willneed=False, readahead=None,
+                 drop_behind=False):
+        self.sequential = sequential
+        self.willneed = willneed
+        self.readahead = readahead
+        self.drop_behind = drop_behind
+
+    def __repr__(self):
+        return ('{0}(sequential={1}, willneed={2}, readahead={3}, '
+                'drop_behind={4})'.format(
+                    self.__class__.__name__, self.sequential, self.willneed,
+                    self.readahead, self.drop_behind))
+
+    def advise(self, fd, offset, length, advice):
+        """posix_fadvise that ignores unsupported platforms and files."""
+        if _fadvise is not None:
+            try:
+                _fadvise(fd, offset, length, advice)
+            except (OSError, IOError):
+                pass
+
+    def open(self, path, mode='rb'):
+        """Open path for reading with the hints of this policy.
+
+        :param mode: 'rb' for binary or 'r' for text mode.
+        :rtype: file-like object supporting read, readline, iteration, seek,
+            tell and close
+        """
+        if mode not in ('r', 'rb'):
+            raise ValueError('mode must be r or rb')
+        return _HintedReader(open(path, mode), self)
+
+
+class _HintedReader(object):
+
+    """A file wrapper applying an :class:`IOPolicy` while reading."""
+
+    def __init__(self, raw, policy):
+        self.raw = raw
+        self.name = raw.name
+        self.policy = policy
+        self._fd = raw.fileno()
+        self._dropped = 0
+        self._ahead = 0
+        if policy.sequential:
+            policy.advise(self._fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        if policy.willneed:
+            policy.advise(self._fd, 0, 0, POSIX_FADV_WILLNEED)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        # Not iter(self.raw), that would read past the hints
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def read(self, size=-1):
+        offset = self._before(size)
+        data = self.raw.read(size)
+        self._after(offset, data)
+        return data
+
+    def readline(self, size=-1):
+        offset = self._before(size)
+        data = self.raw.readline(size)
+        self._after(offset, data)
+        return data
+
+    def _before(self, size):
+        """Read ahead of the current position, return the position."""
+        offset = self.raw.tell()
+        if self.policy.readahead and _readahead is not None:
+            if offset + max(size, 0) >= self._ahead:
+                self._ahead = max(self._ahead, offset)
+                _readahead(self._fd, self._ahead, self.policy.readahead)
+                self._ahead += self.policy.readahead
+        return offset
+
+    def _after(self, offset, data):
+        """Drop behind once data read from offset completes a drop size."""
+        if (self.policy.drop_behind and
+                offset + len(data) - self._dropped >= self.policy.drop_size):
+            self._drop(offset + len(data))
+
+    def seek(self, offset, whence=0):
+        return self.raw.seek(offset, whence)
+
+    def tell(self):
+        return self.raw.tell()
+
+    def fileno(self):
+        return self._fd
+
+    def _drop(self, offset):
+        """Evict everything read from the page cache up to offset."""
+        if offset > self._dropped:
+            self.policy.advise(self._fd, self._dropped,
+                               offset - self._dropped, POSIX_FADV_DONTNEED)
+            self._dropped = offset
+
+    def close(self):
+        if self.raw.closed:
+            return
+        if self.policy.drop_behind:
+            self._drop(self.raw.tell())
+        self.raw.close()
+
+    @property
+    def closed(self):
+        return self.raw.closed
+
+
+def _write_deflated(zip_file, path, arcname, level, chunk_size=64 * 1024):
+    """Deflate the file at path into zip_file with the given zlib level.
+
+    A trimmed copy of ``ZipFile.write`` of the Python 2.7 zipfile module
+    with its own compressor, that zipfile has no compression level. It uses
+    the private ``fp``, ``_writecheck``, ``_didModify`` and ``_allowZip64``
+    of Python 2.7 and must be checked against zipfile when porting.
+    """
+    file_stat = os.stat(path)
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    arcname = arcname.lstrip(os.sep + (os.altsep or ''))
+    zinfo = zipfile.ZipInfo(arcname,
+                            time.localtime(file_stat.st_mtime)[0:6])
+    zinfo.external_attr = (file_stat.st_mode & 0xFFFF) << 16
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.file_size = file_stat.st_size
+    zinfo.header_offset = zip_file.fp.tell()
+    zip_file._writecheck(zinfo)
+    zip_file._didModify = True
+    zip64 = (zip_file._allowZip64 and
+             zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT)
+    # Placeholder header, rewritten once CRC and sizes are known
+    zinfo.CRC = zinfo.compress_size = zinfo.file_size = 0
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    with open(path, 'rb') as the_file:
+        for chunk in iter(lambda: the_file.read(chunk_size), b''):
+            zinfo.file_size += len(chunk)
+            zinfo.CRC = zlib.crc32(chunk, zinfo.CRC) & 0xffffffff
+            data = compressor.compress(chunk)
+            zinfo.compress_size += len(data)
+            zip_file.fp.write(data)
+    data = compressor.flush()
+    zinfo.compress_size += len(data)
+    zip_file.fp.write(data)
+    if not zip64 and max(zinfo.file_size,
+                         zinfo.compress_size) > zipfile.ZIP64_LIMIT:
+        raise RuntimeError('File size has increased during compressing')
+    position = zip_file.fp.tell()
+    zip_file.fp.seek(zinfo.header_offset, 0)
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+    zip_file.fp.seek(position, 0)
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+
+
+class CompressionPolicy(object):
+
+    """
+    Per member compression choice for :meth:`Py7File.rezip`.
+
+    Members with an already compressed extension or mimetype are stored.
+    Other members are deflated unless a quick probe of their first bytes
+    shows they do not compress. Statistics of all written members are
+    collected by extension and returned by :meth:`report`.
+
+    :param level: zlib level from 1 (fast) to 9 (small) for deflated members
+        or `None` for the default.
+    :param probe_size: Number of bytes sampled by the compressibility probe,
+        0 disables the probe.
+    :param max_ratio: Members whose sample does not deflate below this
+        fraction of its size are stored.
+    """
+
+    stored_extensions = frozenset([
+        '7z', 'aac', 'avi', 'bz2', 'docx', 'epub', 'flac', 'gif', 'gz', 'jpeg',
+        'jpg', 'm4a', 'm4v', 'mkv', 'mov', 'mp3', 'mp4', 'odt', 'ogg', 'otf',
+        'png', 'rar', 'webm', 'webp', 'woff', 'woff2', 'xlsx', 'xz', 'zip',
+    ])
+    stored_mimetypes = frozenset([
+        'application/zip', 'application/x-gzip', 'application/x-bzip2',
+        'application/x-xz', 'application/epub+zip', 'font/woff',
+        'font/woff2', 'image/gif', 'image/jpeg', 'image/png', 'image/webp',
+    ])
+
+    def __init__(self, level=None, probe_size=4096, max_ratio=0.9):
+        if level is not None and not 1 <= level <= 9:
+            raise ValueError('level must be between 1 and 9')
+        self.level = level
+        self.probe_size = probe_size
+        self.max_ratio = max_ratio
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def compress_type(self, path):
+        """Choose zipfile compression type for the file at path."""
+        extension = os.path.splitext(path)[-1].lstrip('.').lower()
+        if extension in self.stored_extensions:
+            return zipfile.ZIP_STORED
+        mimetype = mimetypes.guess_type(path)[0] or ''
+        if (mimetype in self.stored_mimetypes or
+                mimetype.split('/')[0] in ('audio', 'video')):
+            return zipfile.ZIP_STORED
+        if self.probe_size:
+            with open(path, 'rb') as the_file:
+                sample = the_file.read(self.probe_size)
+            if (sample and len(zlib.compress(sample, 1)) >
+                    len(sample) * self.max_ratio):
+                return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def write(self, zip_file, path, arcname):
+        """Write file at path as arcname to zip_file and record stats."""
+        compress_type = self.compress_type(path)
+        start = time.time()
+        if compress_type != zipfile.ZIP_DEFLATED or self.level is None:
+            zip_file.write(path, arcname, compress_type)
+        elif sys.version_info >= (3, 7):
+            zip_file.write(path, arcname, compress_type, self.level)
+        else:
+            _write_deflated(zip_file, path, arcname, self.level)
+        seconds = time.time() - start
+        info = zip_file.infolist()[-1]
+        extension = os.path.splitext(arcname)[-1].lstrip('.').lower()
+        with self._lock:
+            stats = self._stats.setdefault(extension, {
+                'members': 0, 'stored': 0, 'bytes': 0, 'saved': 0,
+                'wall_seconds': 0.0})
+            stats['members'] += 1
+            stats['stored'] += compress_type == zipfile.ZIP_STORED
+            stats['bytes'] += info.file_size
+            stats['saved'] += info.file_size - info.compress_size
+            stats['wall_seconds'] += seconds
+
+    def report(self):
+        """Bytes saved and time spent per member extension.
+
+        Time is wall clock time including reads and writes, members are
+        written by parallel threads and Python 2 can not measure the CPU
+        time of a single thread.
+
+        :return: dict mapping extensions to dicts with member count, stored
+            member count, uncompressed bytes, saved bytes and wall_seconds.
+        """
+        with self._lock:
+            return dict((extension, dict(stats))
+                        for extension, stats in self._stats.items())
+
+
+# ioctl request to clone a file on btrfs, xfs and other CoW filesystems
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dest):
+    """Create dest as copy-on-write clone of src (Linux only)."""
+    import fcntl
+    with open(src, 'rb') as src_file:
+        with open(dest, 'wb') as dest_file:
+            fcntl.ioctl(dest_file.fileno(), _FICLONE, src_file.fileno())
+
+
+def _safe_member_path(root, name):
+    """Path below root for zip member name, dropping unsafe components."""
+    parts = [part for part in name.replace('\\', '/').split('/')
+             if part not in ('', '.', '..')]
+    if parts and ':' in parts[0]:
+        parts[0] = parts[0].split(':')[-1]
+    return os.path.join(root, *parts)
+
+
+class ContentStore(object):
+
+    """
+    A store of unique file contents shared by extracted zip members.
+
+    Pass it to :meth:`Py7File.unzip` and members whose content is already
+    in the store are linked instead of written again. Blobs are named
+    ``<crc>-<size>-<md5>`` so the CRC and size from the zip directory rule
+    out most candidates before any member is decompressed.
+
+    Reflinks (copy-on-write clones) and copies are private and safe to
+    edit. Hardlinks are not: a hardlinked member shares one inode with the
+    blob and every other book using it, and any program that writes the
+    member in place changes all of them. Blobs are read-only, but that
+    does not stop the owner or root from writing. Only use
+    ``link='hardlink'`` for trees that are read, never edited, or call
+    :meth:`detach` on a member before editing it.
+
+    :meth:`prune` waits for running :meth:`extract` calls on the same
+    instance and blocks new ones. It must not run while another process
+    extracts into the same store directory.
+
+    :param path: Directory of the store, created if missing.
+    :param link: 'auto' or 'reflink' to clone members on copy-on-write
+        filesystems, 'hardlink' to hardlink them. Members that can not be
+        linked are written as plain files and not added to the store.
+    """
+
+    def __init__(self, path, link='auto'):
+        if link not in ('auto', 'reflink', 'hardlink'):
+            raise ValueError('link must be auto, reflink or hardlink')
+        self.path = os.path.abspath(path)
+        self.link = link
+        self.stats = {'linked': 0, 'stored': 0, 'copied': 0, 'saved': 0}
+        self._shards = {}
+        self._lock = threading.Lock()
+        # prune waits for running extract calls and blocks new ones
+        self._idle = threading.Condition(threading.Lock())
+        self._extracting = 0
+        self._pruning = False
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def __repr__(self):
+        return "{0}(r'{1}')".format(self.__class__.__name__, self.path)
+
+    def _candidates(self, crc, size):
+        """MD5 digests of stored blobs with matching crc and size."""
+        shard = '{0:08x}'.format(crc)[:2]
+        with self._lock:
+            if shard not in self._shards:
+                blobs = {}
+                shard_dir = os.path.join(self.path, shard)
+                if os.path.isdir(shard_dir):
+                    for name in os.listdir(shard_dir):
+                        try:
+                            blob_crc, blob_size, md5 = name.split('-')
+                            key = int(blob_crc, 16), int(blob_size)
+                        except ValueError:
+                            continue
+                        blobs.setdefault(key, set()).add(md5)
+                self._shards[shard] = blobs
+            return set(self._shards[shard].get((crc, size), ()))
+
+    def _blob_path(self, crc, size, md5):
+        crc = '{0:08x}'.format(crc)
+        return os.path.join(self.path, crc[:2],
+                            '{0}-{1}-{2}'.format(crc, size, md5))
+
+    def _add_blob(self, crc, size, md5):
+        with self._lock:
+            shard = self._shards.setdefault('{0:08x}'.format(crc)[:2], {})
+            shard.setdefault((crc, size), set()).add(md5)
+
+    def extract(self, zip_file, info, dest):
+        """Extract zip member info from zip_file to dest via the store."""
+        with self._idle:
+            while self._pruning:
+                self._idle.wait()
+            self._extracting += 1
+        try:
+            self._extract(zip_file, info, dest)
+        finally:
+            with self._idle:
+                self._extracting -= 1
+                self._idle.notify_all()
+
+    def _extract(self, zip_file, info, dest):
+        if os.path.lexists(dest):
+            # Never write through an existing link into a shared blob
+            os.remove(dest)
+        candidates = self._candidates(info.CRC, info.file_size)
+        if candidates:
+            # Decompress without writing to confirm the match
+            member = zip_file.open(info)
+            try:
+                md5 = _copy_segment(member, None, info.file_size + 1)[0]
+            finally:
+                member.close()
+            if md5 in candidates:
+                blob_path = self._blob_path(info.CRC, info.file_size, md5)
+                if self._link(blob_path, dest):
+                    self._count('linked')
+                    self._count('saved', info.file_size)
+                else:
+                    shutil.copyfile(blob_path, dest)
+                    self._count('copied')
+                return
+        member = zip_file.open(info)
+        try:
+            with open(dest, 'wb') as dest_file:
+                md5 = _copy_segment(member, dest_file, info.file_size + 1)[0]
+        finally:
+            member.close()
+        if not self._store(dest, info.CRC, info.file_size, md5):
+            self._count('copied')
+
+    def _store(self, path, crc, size, md5):
+        """Link the extracted file at path into the store as a new blob.
+
+        :return: `False` if it can not be linked, nothing is stored then.
+        """
+        blob_path = self._blob_path(crc, size, md5)
+        shard_dir = os.path.dirname(blob_path)
+        if not os.path.isdir(shard_dir):
+            try:
+                os.makedirs(shard_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        tmp_path = _mktemp(blob_path)
+        try:
+            if not self._link(path, tmp_path):
+                _discard(tmp_path)
+                return False
+            os.chmod(tmp_path, 0o444)
+            _commit(tmp_path, blob_path)
+        except:
+            _discard(tmp_path)
+            raise
+        self._add_blob(crc, size, md5)
+        self._count('stored')
+        return True
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _link(self, src, dest):
+        """Replace dest with a link to src, `False` if linking fails."""
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if self.link in ('auto', 'reflink'):
+            try:
+                _reflink(src, dest)
+                return True
+            except (IOError, OSError, ImportError):
+                _discard(dest)
+        elif self.link == 'hardlink':
+            try:
+                os.link(src, dest)
+                return True
+            except (OSError, AttributeError):
+                # Cross device, too many links or no hardlink support
+                pass
+        return False
+
+    def detach(self, path):
+        """Replace a hardlinked member at path with a private writable copy.
+        """
+        if os.stat(path).st_nlink > 1:
+            tmp_path = _mktemp(path)
+            try:
+                shutil.copyfile(path, tmp_path)
+                os.chmod(tmp_path, 0o644)
+                _commit(tmp_path, path)
+            except:
+                _discard(tmp_path)
+                raise
+
+    def prune(self):
+        """Remove blobs no longer linked from any extracted member.
+
+        Only hardlinked blobs are tracked, blobs used by reflinks or copies
+        are removed too. Waits for running extractions of this instance.
+
+        :return: Number of bytes freed.
+        """
+        with self._idle:
+            while self._extracting or self._pruning:
+                self._idle.wait()
+            self._pruning = True
+        try:
+            freed = 0
+            for relpath, file_stat in _walk_stats(self.path):
+                if file_stat.st_nlink == 1:
+                    os.remove(os.path.join(self.path, relpath))
+                    freed += file_stat.st_size
+            with self._lock:
+                self._shards = {}
+        finally:
+            with self._idle:
+                self._pruning = False
+                self._idle.notify_all()
+        return freed
+
+
+# Compression ratios of members smaller than this are not limited
+_RATIO_THRESHOLD = 1024 * 1024
+
+# Errors raised by gzip, bz2 and lzma on corrupt data
+_STREAM_ERRORS = (IOError, EOFError, zlib.error, ValueError)
+if lzma is not None:
+    _STREAM_ERRORS += (lzma.LZMAError,)
+
+
+def _epub_layout_problems(zip_file):
+    """Check the "mimetype first" packaging rule of the epub OCF spec."""
+    infos = zip_file.infolist()
+    if not infos or infos[0].filename != 'mimetype':
+        return [('mimetype', 'mimetype is not the first member')]
+    problems = []
+    if infos[0].compress_type != zipfile.ZIP_STORED:
+        problems.append(('mimetype', 'mimetype is compressed'))
+    else:
+        try:
+            mimetype = zip_file.read('mimetype')
+        except (zipfile.BadZipfile, zlib.error) as e:
+            problems.append(('mimetype', str(e)))
+        else:
+            if mimetype != b'application/epub+zip':
+                problems.append(('mimetype',
+                                 'mimetype is not application/epub+zip'))
+    if 'META-INF/container.xml' not in zip_file.namelist():
+        problems.append(('META-INF/container.xml', 'container.xml missing'))
+    return problems
+
+
+def _stat_key(path):
+    """Size and mtime of path to detect changes without reading it."""
+    file_stat = os.stat(path)
+    return file_stat.st_size, _mtime_ns(file_stat)
+
+
+def _local_tag(tag):
+    """Strip the namespace from an ElementTree tag."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _read_epub_metadata(path):
+    """Read title, authors, identifier, language and spine of an epub.
+
+    Only container.xml and the OPF package document are read from the zip,
+    the OPF is parsed incrementally up to the end of the spine.
+    """
+    zip_file = zipfile.ZipFile(path)
+    try:
+        container = zip_file.open('META-INF/container.xml')
+        try:
+            opf_path = None
+            for event, elem in ElementTree.iterparse(container):
+                if _local_tag(elem.tag) == 'rootfile':
+                    opf_path = elem.get('full-path')
+                    break
+        finally:
+            container.close()
+        if opf_path is None:
+            raise IOError('No rootfile in META-INF/container.xml')
+
+        metadata = {'title': None, 'authors': [], 'identifier': None,
+                    'language': None, 'spine': []}
+        unique_id = None
+        manifest = {}
+        spine = []
+        opf = zip_file.open(opf_path)
+        try:
+            for event, elem in ElementTree.iterparse(
+                    opf, events=('start', 'end')):
+                tag = _local_tag(elem.tag)
+                if event == 'start':
+                    if tag == 'package':
+                        unique_id = elem.get('unique-identifier')
+                    continue
+                text = (elem.text or '').strip()
+                if tag == 'title' and metadata['title'] is None:
+                    metadata['title'] = text
+                elif tag == 'creator' and text:
+                    metadata['authors'].append(text)
+                elif tag == 'identifier':
+                    if (metadata['identifier'] is None or
+                            elem.get('id') == unique_id):
+                        metadata['identifier'] = text
+                elif tag == 'language' and metadata['language'] is None:
+                    metadata['language'] = text
+                elif tag == 'item':
+                    manifest[elem.get('id')] = elem.get('href')
+                elif tag == 'itemref':
+                    spine.append(elem.get('idref'))
+                elif tag == 'spine':
+                    break
+        finally:
+            opf.close()
+    finally:
+        zip_file.close()
+
+    opf_dir = posixpath.dirname(opf_path)
+    metadata['spine'] = [posixpath.normpath(posixpath.join(opf_dir,
+                                                           manifest[idref]))
+                         for idref in spine if manifest.get(idref)]
+    return metadata
+
+
+# Last group of digits in a filename
+_NUMBER_RE = re.compile(r'(\d+)\D*$')
+_DIGITS_RE = re.compile(r'(\d+)')
+
+
+def _parse_number(name, pattern=None):
+    """Number in name matched by the first group of pattern or None."""
+    if pattern is None:
+        pattern = _NUMBER_RE
+    elif not hasattr(pattern, 'search'):
+        pattern = re.compile(pattern)
+    match = pattern.search(name)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def _natural_key(name):
+    """Sort key ordering embedded numbers numerically ("a2" < "a10")."""
+    parts = _DIGITS_RE.split(name.lower())
+    parts[1::2] = [int(part) for part in parts[1::2]]
+    return tuple(parts)
 
 
 class Py7File(object):
@@ -34,6 +942,11 @@ class Py7File(object):
     :param file_or_path: A path to a file or an actual file object.
     """
 
+    #: :class:`IOPolicy` for reads that may be repeated (read, copy, unzip)
+    io_policy = IOPolicy()
+    #: :class:`IOPolicy` for one-shot scans (hashing, comparing)
+    scan_io_policy = IOPolicy(drop_behind=True)
+
     def __init__(self, file_or_path):
         if (isinstance(file_or_path, file) and hasattr(file_or_path, 'name')
                 and os.path.isfile(file_or_path.name)):
@@ -49,7 +962,11 @@ class Py7File(object):
     def filepath(self):
         """Absolute path to the referenced file."""
         if not isinstance(self._filepath, unicode):
-            return unicode(os.path.abspath(self._filepath), sys.getfilesystemencoding())
+            try:
+                return unicode(os.path.abspath(self._filepath), sys.getfilesystemencoding())
+            except UnicodeDecodeError:
+                # Undecodable names stay byte strings, as os.listdir does
+                return os.path.abspath(self._filepath)
         else:
             return os.path.abspath(self._filepath)
 
@@ -92,26 +1009,47 @@ class Py7File(object):
         another file.
         """
         if isinstance(other, (Py7File, EpubFile)):
-            return filecmp.cmp(self.filepath, other.filepath, shallow=False)
+            other_path = other.filepath
         elif isinstance(other, file):
-            return filecmp.cmp(self.filepath, other.name, shallow=False)
+            other_path = other.name
         elif isinstance(other, (str, unicode)) and os.path.isfile(other):
-            return filecmp.cmp(self.filepath, other, shallow=False)
+            other_path = other
         else:
             return NotImplemented
-
-    def read(self, size=None):
-        """Read file, close and return data."""
-        with open(self.filepath) as the_file:
+        if os.path.getsize(self.filepath) != os.path.getsize(other_path):
+            return False
+        policy = self.scan_io_policy
+        bufsize = 64 * 1024
+        with policy.open(self.filepath) as this_file:
+            with policy.open(other_path) as other_file:
+                while True:
+                    data = this_file.read(bufsize)
+                    if data != other_file.read(bufsize):
+                        return False
+                    if not data:
+                        return True
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def read(self, size=None, io_policy=None):
+        """Read file, close and return data.
+
+        :param io_policy: :class:`IOPolicy` overriding :attr:`io_policy`.
+        """
+        with (io_policy or self.io_policy).open(self.filepath,
+                                                'r') as the_file:
             if size:
                 data = the_file.read(size)
             else:
                 data = the_file.read()
         return data
 
-    def backup(self):
+    def backup(self, durable=False):
         """Create a backup with auto incremented version number in filename.
 
+        :param durable: see :meth:`copy`
         :rtype: :class:`py7file.Py7File` instance of backup file.
         """
 
@@ -129,39 +1067,209 @@ class Py7File(object):
             if len(self.extension):
                 out_path += '.' + self.extension
 
-        self.copy(out_path)
+        self.copy(out_path, durable=durable)
         return self.__class__(out_path)
 
-    def restore(self):
+    def restore(self, durable=False):
         """Restore referenced file from latest backup"""
         latest_backup = self.__class__(self.get_backups()[-1])
-        latest_backup.copy(self.filepath)
+        latest_backup.copy(self.filepath, durable=durable)
+
+    def _resolve_dest(self, dest):
+        """Destination filepath for copy/move to a directory or filepath."""
+        if os.path.isdir(dest):
+            return os.path.join(dest, self.filename)
+        return dest
 
-    def copy(self, dest, secure=True):
+    def copy(self, dest, secure=True, durable=False, resumable=False,
+             io_policy=None):
         """Copy file to existing destination directory or filepath.
 
+        The copy is written to a temporary file next to the destination and
+        renamed into place, so the destination is never left half written.
+
+        :param durable: `True` to fsync the copy and its directory before
+            returning or a :class:`FsyncBatch` to defer the fsync calls.
+        :param resumable: Checkpoint the copy so an interrupted copy to the
+            same destination resumes where it stopped. The copy is verified
+            against the source digests before it is renamed into place.
+        :param io_policy: :class:`IOPolicy` for reading the source,
+            overriding :attr:`io_policy`.
         :rtype: :class:`py7file.Py7File` instance of copied file.
         """
+        dest = self._resolve_dest(dest)
         if secure and os.path.isfile(dest):
             raise IOError('Destination file already exists')
-        else:
-            shutil.copy(self.filepath, dest)
+        if resumable:
+            self._resumable_copy(dest, durable)
             return self.__class__(dest)
-
-    def move(self, dest, secure=True):
+        tmp_path = _mktemp(dest)
+        try:
+            with (io_policy or self.io_policy).open(self.filepath) as src:
+                with open(tmp_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            shutil.copymode(self.filepath, tmp_path)
+            _commit(tmp_path, dest, durable)
+        except:
+            _discard(tmp_path)
+            raise
+        return self.__class__(dest)
+
+    def move(self, dest, secure=True, durable=False):
         """Move file to existing destination directory or filepath.
 
         This deletes the file that the current Py7File object references.
         So it mutates itself to reference the new file and also returns self.
 
+        Moves across filesystems are done as a resumable, verified
+        :meth:`copy` followed by removal of the source. An interrupted move
+        resumes when called again with the same destination.
+
+        :param durable: see :meth:`copy`
         :rtype: :class:`py7file.Py7File` instance of moved file.
         """
+        dest = self._resolve_dest(dest)
         if secure and os.path.isfile(dest):
             raise IOError('Destination file already exists')
-        else:
-            shutil.move(self.filepath, dest)
-            self._filepath = dest
-            return self
+        try:
+            if os.name == 'nt' and os.path.exists(dest):
+                os.remove(dest)
+            os.rename(self.filepath, dest)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            self._resumable_copy(dest, durable)
+            os.remove(self.filepath)
+        if durable is True:
+            _fsync_dir(os.path.dirname(os.path.abspath(dest)))
+            _fsync_dir(self.location)
+        elif isinstance(durable, FsyncBatch):
+            durable.add_dir(os.path.dirname(os.path.abspath(dest)))
+            durable.add_dir(self.location)
+        self._filepath = dest
+        return self
+
+    #: Bytes copied between checkpoints of resumable copies
+    checkpoint_size = 64 * 1024 * 1024
+
+    def _resumable_copy(self, dest, durable=False):
+        """Copy to dest via a checkpointed ``.part`` file next to it.
+
+        The checkpoint holds the source stat key, the copied offset and MD5
+        digests of every copied segment. It is only written after the part
+        file is synced, so after a crash the copy resumes at the last
+        checkpoint. Before the rename the part file is read back and
+        compared against the segment digests.
+        """
+        location, filename = os.path.split(os.path.abspath(dest))
+        part_path = os.path.join(location, '.' + filename + '.part')
+        checkpoint_path = part_path + '.json'
+        segment_size = self.checkpoint_size
+        state = {'source': self.filepath,
+                 'key': list(_stat_key(self.filepath)),
+                 'segment_size': segment_size, 'offset': 0, 'digests': []}
+        try:
+            with open(checkpoint_path, 'rb') as checkpoint_file:
+                saved = json.loads(checkpoint_file.read().decode('utf-8'))
+            if (all(saved.get(k) == state[k] for k in
+                    ('source', 'key', 'segment_size')) and
+                    os.path.getsize(part_path) >= saved['offset']):
+                state = saved
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        with self.io_policy.open(self.filepath) as src:
+            with open(part_path, 'r+b' if state['offset'] else 'wb') as part:
+                part.truncate(state['offset'])
+                part.seek(state['offset'])
+                src.seek(state['offset'])
+                while True:
+                    digest, length = _copy_segment(src, part, segment_size)
+                    if not length:
+                        break
+                    state['digests'].append(digest)
+                    state['offset'] += length
+                    if length < segment_size:
+                        break
+                    part.flush()
+                    os.fsync(part.fileno())
+                    tmp_path = _mktemp(checkpoint_path)
+                    try:
+                        with open(tmp_path, 'wb') as checkpoint_file:
+                            checkpoint_file.write(
+                                json.dumps(state).encode('utf-8'))
+                        _commit(tmp_path, checkpoint_path)
+                    except:
+                        _discard(tmp_path)
+                        raise
+
+        if state['key'] != list(_stat_key(self.filepath)):
+            raise IOError('Source changed while copying')
+        with self.scan_io_policy.open(part_path) as part:
+            verified = all(_copy_segment(part, None, segment_size)[0] == digest
+                           for digest in state['digests'])
+            verified = verified and not part.read(1)
+        if not verified:
+            _discard(part_path)
+            _discard(checkpoint_path)
+            raise IOError('Verification of copy failed')
+        shutil.copymode(self.filepath, part_path)
+        _commit(part_path, dest, durable)
+        _discard(checkpoint_path)
+
+    def sync_to(self, dest, block_size=1024 * 1024, manifest=None,
+                durable=False):
+        """Update destination directory or filepath in place to match file.
+
+        Source and destination are compared block by block and only blocks
+        that differ are written. The destination is created if missing and
+        truncated or extended to the size of the referenced file.
+
+        :param block_size: Size of the compared blocks in bytes.
+        :param manifest: Path to a cache of the block digests of the
+            destination. While it matches size and mtime of the destination,
+            the destination is not read at all. It is rewritten on every sync.
+        :param durable: see :meth:`copy`
+        :rtype: :class:`py7file.Py7File` instance of synced file.
+        """
+        dest = self._resolve_dest(dest)
+        if not os.path.isfile(dest):
+            open(dest, 'ab').close()
+            shutil.copymode(self.filepath, dest)
+        cached = None
+        if manifest:
+            cached = _read_block_manifest(manifest, dest, block_size)
+        digests = []
+        offset = 0
+        with open(self.filepath, 'rb') as src:
+            with open(dest, 'r+b') as dst:
+                while True:
+                    data = src.read(block_size)
+                    if not data:
+                        break
+                    if manifest:
+                        digests.append(hashlib.md5(data).hexdigest())
+                    if cached is not None:
+                        index = len(digests) - 1
+                        changed = (index >= len(cached) or
+                                   cached[index] != digests[index])
+                    else:
+                        dst.seek(offset)
+                        changed = dst.read(len(data)) != data
+                    if changed:
+                        dst.seek(offset)
+                        dst.write(data)
+                    offset += len(data)
+                # Skip a truncate that changes nothing, it bumps the mtime
+                if os.fstat(dst.fileno()).st_size != offset:
+                    dst.truncate(offset)
+        if durable is True:
+            _fsync_file(dest)
+        elif isinstance(durable, FsyncBatch):
+            durable.add_file(dest)
+        if manifest:
+            _write_block_manifest(manifest, dest, block_size, digests)
+        return self.__class__(dest)
 
     def delete(self):
         """Delete file from disk but keep object data for eventual restore."""
@@ -191,14 +1299,16 @@ class Py7File(object):
         """
         return os.path.getsize(self.filepath)
 
-    def get_md5(self):
+    def get_md5(self, io_policy=None):
         """
+        :param io_policy: :class:`IOPolicy` overriding
+            :attr:`scan_io_policy`.
         :return: MD5 hash of the file.
         """
-        file_obj = open(self._filepath, 'rb')
+        file_obj = (io_policy or self.scan_io_policy).open(self._filepath)
         md5_caldulator = hashlib.md5()
         while True:
-            data = file_obj.read(128)
+            data = file_obj.read(64 * 1024)
             if not data:
                 break
             md5_caldulator.update(data)
@@ -211,18 +1321,17 @@ class Py7File(object):
         """
         return mimetypes.guess_type(self.filename)[0]
 
-    def get_number(self):
+    def get_number(self, pattern=None):
         """Scan filename for numbering.
 
+        By default the last group of digits in the filename (without
+        extension) is the number, so ``v2_page010.tif`` is number 10.
+
+        :param pattern: A regex whose first group matches the number.
         :return: The file number as an integer or None
         :rtype: int, None
         """
-        number = [n for n in self.trunc if n in string.digits]
-        number = ''.join(number)
-        if number:
-            return int(number)
-        else:
-            return None
+        return _parse_number(self.trunc, pattern)
 
     def get_sanitized_filename(self):
         """Create a sanatized version of the filename.
@@ -250,16 +1359,29 @@ class Py7File(object):
 
         return filename
 
-    def unzip(self):
+    def unzip(self, store=None):
         """Unzip the file to [filename]_unzipped named subfolder.
 
+        :param store: A :class:`ContentStore` to link members with content
+            already extracted from other archives instead of writing them.
         :returns: list of Py7File objects for all extracted files
         """
         unzipped_files = list()
         if self.extension in ['zip', 'epub', '']:
             zip_file = zipfile.ZipFile(self.filepath)
             try:
-                zip_file.extractall(self.zipdir)
+                if store is None:
+                    zip_file.extractall(self.zipdir)
+                else:
+                    for info in zip_file.infolist():
+                        dest = _safe_member_path(self.zipdir, info.filename)
+                        if info.filename.endswith('/'):
+                            if not os.path.isdir(dest):
+                                os.makedirs(dest)
+                            continue
+                        if not os.path.isdir(os.path.dirname(dest)):
+                            os.makedirs(os.path.dirname(dest))
+                        store.extract(zip_file, info, dest)
             finally:
                 zip_file.close()
 
@@ -267,32 +1389,102 @@ class Py7File(object):
                 for f in files:
                     unzipped_files.append(Py7File(os.path.join(root, f)))
         elif self.extension == 'gz':
-            gz_file = gzip.GzipFile(self.filepath, 'rb')
             if not os.path.isdir(self.zipdir):
                 os.mkdir(self.zipdir)
             outpath = os.path.join(self.zipdir, self.trunc)
-            unzipped_file = file(outpath, 'wb')
-            while 1:
-                lines = gz_file.readline()
-                if lines == '':
-                    break
-                unzipped_file.write(lines)
-            gz_file.close()
-            unzipped_file.close()
+            with open(outpath, 'wb') as unzipped_file:
+                for chunk in self.iter_decompressed():
+                    unzipped_file.write(chunk)
             unzipped_files.append(Py7File(outpath))
         return unzipped_files
 
-    def rezip(self):
-        """Re-Zip a previously unzipped file and remove unzipped folder."""
+    def open_decompressed(self, member=None):
+        """Open a read-only file object on the decompressed contents.
+
+        Works for gz, bz2 and xz (needs lzma) compressed files and single
+        members of zip files. Nothing is written to disk.
+
+        :param member: Name of the zip member to open. May be omitted for zip
+            files with a single member.
+        :rtype: file-like object to be closed by the caller
+        """
+        if self.extension == 'gz':
+            gz_file = gzip.GzipFile(fileobj=self.io_policy.open(self.filepath),
+                                    mode='rb')
+            # Let GzipFile close the hinted file it does not own otherwise
+            gz_file.myfileobj = gz_file.fileobj
+            return gz_file
+        elif self.extension == 'bz2':
+            return bz2.BZ2File(self.filepath, 'rb')
+        elif self.extension == 'xz':
+            if lzma is None:
+                raise IOError('xz support needs the lzma module')
+            return lzma.LZMAFile(self.filepath, 'rb')
+        elif self.is_zip_file():
+            zip_file = zipfile.ZipFile(self.filepath)
+            try:
+                if member is None:
+                    members = [info.filename for info in zip_file.infolist()
+                               if not info.filename.endswith('/')]
+                    if len(members) != 1:
+                        raise ValueError('Need a member name for zip files '
+                                         'with {0} members'.format(
+                                             len(members)))
+                    member = members[0]
+                return zip_file.open(member)
+            finally:
+                zip_file.close()
+        raise IOError('"{0}" is not a compressed file'.format(self.filename))
+
+    def iter_decompressed(self, chunk_size=64 * 1024, member=None):
+        """Iterate over the decompressed contents in chunks of chunk_size.
+
+        Memory use is bounded by chunk_size regardless of the file size.
+        See :meth:`open_decompressed` for supported formats.
+
+        :param member: Name of the zip member to read.
+        """
+        the_file = self.open_decompressed(member)
+        try:
+            while True:
+                chunk = the_file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            the_file.close()
+
+    def rezip(self, durable=False, policy=None):
+        """Re-Zip a previously unzipped file and remove unzipped folder.
+
+        The archive is written to a temporary file and replaces the original
+        only when complete.
+
+        :param durable: see :meth:`copy`
+        :param policy: A :class:`CompressionPolicy` choosing the compression
+            of each member. Defaults to a new ``CompressionPolicy()``.
+        """
+        if policy is None:
+            policy = CompressionPolicy()
         #TODO need special handling for .gz files
-        fzip = zipfile.ZipFile(self.filepath, 'w', zipfile.ZIP_DEFLATED)
         if not os.path.isdir(self.zipdir):
-            raise IOError('No "{}" folder to rezip'.format(self.trunc))
-        for root, dirs, files in os.walk(self.zipdir):
-            dirname = root.replace(self.zipdir, '')
-            for the_file  in files:
-                fzip.write(root + '/' + the_file, dirname + '/' + the_file)
-        fzip.close()
+            raise IOError('No "{0}" folder to rezip'.format(self.trunc))
+        tmp_path = _mktemp(self.filepath)
+        try:
+            fzip = zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED)
+            try:
+                for root, dirs, files in os.walk(self.zipdir):
+                    dirname = root.replace(self.zipdir, '')
+                    for the_file in files:
+                        policy.write(fzip, root + '/' + the_file,
+                                     dirname + '/' + the_file)
+            finally:
+                fzip.close()
+            shutil.copymode(self.filepath, tmp_path)
+            _commit(tmp_path, self.filepath, durable)
+        except:
+            _discard(tmp_path)
+            raise
         self.delete_zip_folder()
 
     def cleanup(self):
@@ -316,15 +1508,14 @@ class Py7File(object):
         :rtype: boolean
 
         """
-        the_file = open(self.filepath, 'rb')
-
-        # Check for Byte-Order-Marker
-        fragment = the_file.read(128)
-        if fragment.startswith(codecs.BOM):
-            return False
-
-        the_file.seek(0)
+        the_file = self.scan_io_policy.open(self.filepath)
         try:
+            # Check for Byte-Order-Marker
+            fragment = the_file.read(128)
+            if fragment.startswith(codecs.BOM):
+                return False
+
+            the_file.seek(0)
             bsize = 1024
             while 1:
                 fragment = the_file.read(bsize)
@@ -343,6 +1534,136 @@ class Py7File(object):
         """
         return zipfile.is_zipfile(self.filepath)
 
+    def verify_archive(self, workers=1, fail_fast=False, check_layout=None,
+                       max_ratio=100, max_size=None, chunk_size=64 * 1024):
+        """Check integrity of a zip, epub or gz/bz2/xz file without extracting.
+
+        All zip members are decompressed in memory and CRC checked, in
+        parallel with workers > 1. Compressed streams are checked against
+        their trailers. Zip bomb limits are enforced on the declared sizes
+        up front and again on the actual data while streaming.
+
+        :param workers: Number of members checked in parallel.
+        :param fail_fast: Stop at the first problem found.
+        :param check_layout: Check the epub "mimetype first" layout. Defaults
+            to `True` for files with epub extension.
+        :param max_ratio: Maximum uncompressed/compressed size ratio for
+            members that decompress to more than 1 MiB.
+        :param max_size: Maximum total uncompressed size in bytes.
+        :return: list of (member, reason) tuples, empty if the archive is
+            fine. Member is `None` for problems of the whole archive.
+        :rtype: `list`
+        """
+        if not self.is_zip_file():
+            if self.extension in ('gz', 'bz2', 'xz'):
+                return self._verify_stream(max_ratio, max_size, chunk_size)
+            return [(None, 'not an archive')]
+        try:
+            zip_file = zipfile.ZipFile(self.filepath)
+        except (zipfile.BadZipfile, zipfile.LargeZipFile, IOError) as e:
+            return [(None, str(e))]
+        try:
+            infos = zip_file.infolist()
+            problems = []
+            if check_layout or (check_layout is None and
+                                self.extension == 'epub'):
+                problems.extend(_epub_layout_problems(zip_file))
+        finally:
+            zip_file.close()
+
+        members = [info for info in infos if not info.filename.endswith('/')]
+        for info in members:
+            name = info.filename.replace('\\', '/')
+            if (name.startswith('/') or '..' in name.split('/') or
+                    ':' in name.split('/')[0]):
+                problems.append((info.filename, 'unsafe member path'))
+            if (info.file_size > _RATIO_THRESHOLD and info.file_size >
+                    max_ratio * max(info.compress_size, 1)):
+                problems.append((info.filename, 'compression ratio exceeds '
+                                 '{0}'.format(max_ratio)))
+        if max_size is not None:
+            declared = sum(info.file_size for info in members)
+            if declared > max_size:
+                problems.append((None, 'uncompressed size exceeds '
+                                 '{0}'.format(max_size)))
+        if problems and fail_fast:
+            return problems
+
+        stop = threading.Event()
+        lock = threading.Lock()
+        total = [0]
+        local = threading.local()
+        handles = []
+
+        def check(info):
+            if stop.is_set():
+                return None
+            if info.flag_bits & 0x1:
+                return info.filename, 'encrypted member can not be verified'
+            if not hasattr(local, 'zip_file'):
+                local.zip_file = zipfile.ZipFile(self.filepath)
+                with lock:
+                    handles.append(local.zip_file)
+            size = 0
+            try:
+                member = local.zip_file.open(info)
+                try:
+                    while not stop.is_set():
+                        chunk = member.read(chunk_size)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        if (size > _RATIO_THRESHOLD and size >
+                                max_ratio * max(info.compress_size, 1)):
+                            return (info.filename, 'compression ratio '
+                                    'exceeds {0}'.format(max_ratio))
+                        if max_size is not None:
+                            with lock:
+                                total[0] += len(chunk)
+                                exceeded = total[0] > max_size
+                            if exceeded:
+                                return (info.filename, 'uncompressed size '
+                                        'exceeds {0}'.format(max_size))
+                finally:
+                    member.close()
+            except (zipfile.BadZipfile, zlib.error, IOError, EOFError,
+                    NotImplementedError, RuntimeError) as e:
+                return info.filename, str(e)
+            return None
+
+        pool = ThreadPool(max(workers, 1))
+        try:
+            for problem in pool.imap_unordered(check, members):
+                if problem:
+                    problems.append(problem)
+                    if fail_fast:
+                        stop.set()
+                        break
+        finally:
+            pool.close()
+            pool.join()
+            for handle in handles:
+                handle.close()
+        return sorted(set(problems), key=lambda p: (p[0] or '', p[1]))
+
+    def _verify_stream(self, max_ratio, max_size, chunk_size):
+        """Check a gz, bz2 or xz file by decompressing it to nowhere."""
+        compressed_size = max(self.get_filesize(), 1)
+        size = 0
+        try:
+            for chunk in self.iter_decompressed(chunk_size):
+                size += len(chunk)
+                if (size > _RATIO_THRESHOLD and
+                        size > max_ratio * compressed_size):
+                    return [(None, 'compression ratio exceeds '
+                             '{0}'.format(max_ratio))]
+                if max_size is not None and size > max_size:
+                    return [(None, 'uncompressed size exceeds '
+                             '{0}'.format(max_size))]
+        except _STREAM_ERRORS as e:
+            return [(None, str(e) or e.__class__.__name__)]
+        return []
+
     def _replace_under_error_handler(self, error):
         """Handle encoding errors with '_' replacement"""
         return u'_' * (error.end - error.start), error.end
@@ -351,8 +1672,30 @@ class Py7File(object):
 class EpubFile(Py7File):
     """An ePub file with special rezip handling"""
 
-    def rezip(self):
-        """Re-Zip a previously unzipped epub and remove unzipped folder."""
+    _metadata = None
+
+    @property
+    def metadata(self):
+        """Title, authors, identifier, language and spine of the epub.
+
+        Read straight from the zip without unzipping and cached until size
+        or mtime of the file change.
+
+        :rtype: `dict` with spine as list of archive paths in reading order.
+        """
+        key = _stat_key(self.filepath)
+        if self._metadata is None or self._metadata[0] != key:
+            self._metadata = key, _read_epub_metadata(self.filepath)
+        return self._metadata[1]
+
+    def rezip(self, durable=False, policy=None):
+        """Re-Zip a previously unzipped epub and remove unzipped folder.
+
+        :param durable: see :meth:`Py7File.copy`
+        :param policy: see :meth:`Py7File.rezip`
+        """
+        if policy is None:
+            policy = CompressionPolicy()
 
         exclude_files = ['.DS_Store', 'mimetype', 'iTunesMetadata.plist']
         parent_dir, dir_to_zip = os.path.split(self.zipdir)
@@ -365,22 +1708,966 @@ class EpubFile(Py7File):
             zip_path = zip_path.replace(dir_to_zip + os.path.sep, "", 1)
             return zip_path
 
-        outfile = zipfile.ZipFile(self.filepath, "w",
-                                  compression=zipfile.ZIP_DEFLATED)
+        tmp_path = _mktemp(self.filepath)
+        try:
+            outfile = zipfile.ZipFile(tmp_path, "w",
+                                      compression=zipfile.ZIP_DEFLATED)
+            try:
+                # ePub Zips need uncompressed mimetype-file as first file
+                outfile.write(os.path.join(self.zipdir, 'mimetype'),
+                              'mimetype', compress_type=0)
+
+                for root, dirs, files in os.walk(self.zipdir):
+                    for file_name in files:
+                        if file_name in exclude_files:
+                            continue
+                        file_path = os.path.join(root, file_name)
+                        policy.write(outfile, file_path, trim(file_path))
+                    # Also add empty directories
+                    if not files and not dirs:
+                        zip_info = zipfile.ZipInfo(trim(root) + "/")
+                        outfile.writestr(zip_info, "")
+            finally:
+                outfile.close()
+            shutil.copymode(self.filepath, tmp_path)
+            _commit(tmp_path, self.filepath, durable)
+        except:
+            _discard(tmp_path)
+            raise
+        self.delete_zip_folder()
+
+
+SnapshotDiff = namedtuple('SnapshotDiff', 'added removed modified renamed')
+
+
+class TreeSnapshot(object):
+
+    """
+    Stat records of all files below a directory for cheap change detection.
 
-        # ePub Zips need uncompressed mimetype-file as first file
-        outfile.write(os.path.join(self.zipdir, 'mimetype'), 'mimetype',
-                      compress_type=0)
+    Every regular file is recorded as ``(inode, size, mtime_ns, digest)``
+    keyed by its path relative to root. The digest is an MD5 hex string or
+    `None` if the snapshot was scanned without digests.
 
-        for root, dirs, files in os.walk(self.zipdir):
-            for file_name in files:
-                if file_name in exclude_files:
+    :param root: Directory the snapshot was taken of.
+    :param entries: dict mapping relative paths to records.
+    """
+
+    version = 1
+
+    def __init__(self, root, entries=None):
+        if not isinstance(root, unicode):
+            root = unicode(root, sys.getfilesystemencoding())
+        self.root = os.path.abspath(root)
+        self.entries = entries if entries is not None else {}
+
+    def __repr__(self):
+        return "{0}(r'{1}')".format(self.__class__.__name__, self.root)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def scan(cls, root, digest=False, previous=None):
+        """Take a snapshot of all files below root.
+
+        :param digest: Also record the MD5 hash of every file.
+        :param previous: An earlier snapshot of the same tree. Digests of
+            files with unchanged inode, size and mtime are taken from it
+            instead of rehashing the file.
+        :rtype: :class:`py7file.TreeSnapshot`
+        """
+        snapshot = cls(root)
+        known = previous.entries if previous is not None else {}
+        for relpath, file_stat in _walk_stats(snapshot.root):
+            record = (file_stat.st_ino, file_stat.st_size,
+                      _mtime_ns(file_stat))
+            md5 = None
+            if digest:
+                old = known.get(relpath)
+                if old is not None and old[:3] == record and old[3]:
+                    md5 = old[3]
+                else:
+                    try:
+                        md5 = Py7File(os.path.join(snapshot.root,
+                                                   relpath)).get_md5()
+                    except (IOError, OSError, TypeError):
+                        # vanished while scanning
+                        continue
+            snapshot.entries[relpath] = record + (md5,)
+        return snapshot
+
+    def save(self, path):
+        """Atomically write the snapshot as gzipped json lines to path."""
+        tmp_path = _mktemp(path)
+        try:
+            gz_file = gzip.GzipFile(tmp_path, 'wb')
+            try:
+                header = {'root': self.root, 'version': self.version}
+                gz_file.write(json.dumps(header).encode('utf-8') + b'\n')
+                for relpath in sorted(self.entries):
+                    line = json.dumps([relpath] + list(self.entries[relpath]))
+                    gz_file.write(line.encode('utf-8') + b'\n')
+            finally:
+                gz_file.close()
+            _commit(tmp_path, path)
+        except:
+            _discard(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Read a snapshot written by :meth:`save`.
+
+        :rtype: :class:`py7file.TreeSnapshot`
+        """
+        gz_file = gzip.GzipFile(path, 'rb')
+        try:
+            header = json.loads(gz_file.readline().decode('utf-8'))
+            if header.get('version') != cls.version:
+                raise ValueError('Unsupported snapshot version')
+            entries = {}
+            for line in gz_file:
+                relpath, ino, size, mtime_ns, md5 = json.loads(
+                    line.decode('utf-8'))
+                entries[relpath] = (ino, size, mtime_ns, md5)
+        finally:
+            gz_file.close()
+        return cls(header['root'], entries)
+
+    def diff(self, previous):
+        """Compare snapshot against an earlier snapshot of the same tree.
+
+        Files are modified if their digests differ or, without digests on
+        both sides, if inode, size or mtime changed. A removed and an added
+        file count as rename if they share inode, size and mtime or digest.
+
+        :return: A :class:`SnapshotDiff` with sorted lists of relative paths
+            for added, removed and modified files and (old, new) tuples for
+            renamed files.
+        """
+        old, new = previous.entries, self.entries
+        added = set(new) - set(old)
+        removed = set(old) - set(new)
+        modified = []
+        for relpath in set(new) & set(old):
+            old_record, new_record = old[relpath], new[relpath]
+            if old_record[3] and new_record[3]:
+                if old_record[3] != new_record[3]:
+                    modified.append(relpath)
+            elif old_record[:3] != new_record[:3]:
+                modified.append(relpath)
+
+        by_stat = dict((old[relpath][:3], relpath) for relpath in removed)
+        by_digest = dict((old[relpath][3], relpath) for relpath in removed
+                         if old[relpath][3])
+        renamed = []
+        for relpath in sorted(added):
+            record = new[relpath]
+            source = by_stat.get(record[:3])
+            if source is None and record[3]:
+                source = by_digest.get(record[3])
+            if source is not None and source in removed:
+                renamed.append((source, relpath))
+                removed.discard(source)
+        for source, relpath in renamed:
+            added.discard(relpath)
+        return SnapshotDiff(sorted(added), sorted(removed), sorted(modified),
+                            renamed)
+
+
+class EpubIndex(object):
+
+    """
+    A sqlite index of epub metadata for a whole library.
+
+    :meth:`update` only reads epubs that are new or changed since the last
+    update. Authors and spine are stored as json lists.
+
+    :param path: Path of the sqlite database, created if missing.
+    """
+
+    fields = ('title', 'authors', 'identifier', 'language', 'spine')
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS books ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+            'title TEXT, authors TEXT, identifier TEXT, language TEXT, '
+            'spine TEXT, error TEXT)')
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+
+    def close(self):
+        """Close the database."""
+        self._db.close()
+
+    def update(self, root, workers=4):
+        """Add new and changed epubs below root and drop vanished ones.
+
+        :param workers: Number of epubs read in parallel.
+        :return: dict with counts of added, updated, removed, unchanged and
+            failed books. Books that fail to read only count as failed.
+        """
+        if not isinstance(root, unicode):
+            root = unicode(root, sys.getfilesystemencoding())
+        root = os.path.abspath(root)
+        prefix = os.path.join(root, '')
+        known = dict((path, (size, mtime_ns)) for path, size, mtime_ns in
+                     self._db.execute('SELECT path, size, mtime_ns FROM books')
+                     if path.startswith(prefix))
+        counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0,
+                  'failed': 0}
+        pending = []
+        for relpath, file_stat in _walk_stats(root):
+            if not relpath.lower().endswith('.epub'):
+                continue
+            path = os.path.join(root, relpath)
+            key = file_stat.st_size, _mtime_ns(file_stat)
+            old = known.pop(path, None)
+            if old == key:
+                counts['unchanged'] += 1
+            else:
+                pending.append((path, key, old is None))
+
+        def read(job):
+            path, key, new = job
+            try:
+                return job, _read_epub_metadata(path), None
+            except Exception as e:
+                return job, None, str(e) or e.__class__.__name__
+
+        pool = ThreadPool(max(workers, 1))
+        try:
+            for (path, key, new), metadata, error in pool.imap_unordered(
+                    read, pending):
+                row = [path, key[0], key[1]]
+                if metadata is None:
+                    row += [None] * len(self.fields) + [error]
+                    counts['failed'] += 1
+                else:
+                    row += [metadata['title'],
+                            json.dumps(metadata['authors']),
+                            metadata['identifier'], metadata['language'],
+                            json.dumps(metadata['spine']), None]
+                    counts['added' if new else 'updated'] += 1
+                self._db.execute('INSERT OR REPLACE INTO books VALUES '
+                                 '(?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+        finally:
+            pool.close()
+            pool.join()
+        for path in known:
+            self._db.execute('DELETE FROM books WHERE path = ?', (path,))
+            counts['removed'] += 1
+        self._db.commit()
+        return counts
+
+    def search(self, **fields):
+        """Find books whose fields contain all given values (case insensitive).
+
+        Example: ``index.search(author='tolkien', language='en')``
+
+        :return: list of metadata dicts with an additional path key.
+        """
+        columns = {'author': 'authors'}
+        where, args = [], []
+        for field, value in sorted(fields.items()):
+            column = columns.get(field, field)
+            if column not in self.fields + ('path',):
+                raise ValueError('Unknown field {0}'.format(field))
+            where.append('{0} LIKE ?'.format(column))
+            args.append('%' + value + '%')
+        query = 'SELECT path, {0} FROM books WHERE error IS NULL'.format(
+            ', '.join(self.fields))
+        if where:
+            query += ' AND ' + ' AND '.join(where)
+        return [self._row_to_dict(row) for row in
+                self._db.execute(query + ' ORDER BY path', args)]
+
+    def get(self, path):
+        """Metadata dict of the book at path or `None`."""
+        if not isinstance(path, unicode):
+            path = unicode(path, sys.getfilesystemencoding())
+        row = self._db.execute('SELECT path, {0} FROM books WHERE path = ? '
+                               'AND error IS NULL'.format(
+                                   ', '.join(self.fields)),
+                               (os.path.abspath(path),)).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def errors(self):
+        """List of (path, error) tuples of epubs that could not be read."""
+        return self._db.execute('SELECT path, error FROM books WHERE error '
+                                'IS NOT NULL ORDER BY path').fetchall()
+
+    def _row_to_dict(self, row):
+        book = dict(zip(('path',) + self.fields, row))
+        book['authors'] = json.loads(book['authors'])
+        book['spine'] = json.loads(book['spine'])
+        return book
+
+
+def index_library(root, index_path=None, workers=4):
+    """Build or refresh the epub metadata index of a library.
+
+    :param index_path: Path of the sqlite index, defaults to
+        ``.epub_index.sqlite`` in root.
+    :rtype: :class:`py7file.EpubIndex`
+    """
+    if index_path is None:
+        index_path = os.path.join(root, '.epub_index.sqlite')
+    index = EpubIndex(index_path)
+    index.update(root, workers=workers)
+    return index
+
+
+class SequenceIndex(object):
+
+    """
+    Numbered files of a directory in the order of their numbers.
+
+    Filenames are parsed once with :meth:`Py7File.get_number` semantics and
+    kept sorted by number and natural sort key, so lookups by number are
+    bisections and :meth:`refresh` only parses new filenames. Files without
+    number are listed in :attr:`unnumbered`.
+
+    :param directory: Directory of the numbered files.
+    :param pattern: A regex whose first group matches the number, defaults
+        to the last group of digits in the filename without extension.
+    :param extensions: Only index files with one of these extensions.
+    """
+
+    def __init__(self, directory, pattern=None, extensions=None):
+        self.directory = os.path.abspath(directory)
+        self.pattern = re.compile(pattern) if pattern else _NUMBER_RE
+        self.extensions = (set(e.lstrip('.').lower() for e in extensions)
+                           if extensions else None)
+        self.unnumbered = set()
+        self._keys = []
+        self._names = {}
+        self.refresh()
+
+    def __repr__(self):
+        return "{0}(r'{1}')".format(self.__class__.__name__, self.directory)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        """Iterate over filenames in sequence order."""
+        return (key[2] for key in self._keys)
+
+    def __getitem__(self, position):
+        """Filename at position in sequence order."""
+        return self._keys[position][2]
+
+    def _accepts(self, filename):
+        extension = os.path.splitext(filename)[-1].lstrip('.').lower()
+        return self.extensions is None or extension in self.extensions
+
+    def _key(self, filename):
+        if not self._accepts(filename):
+            return None
+        number = _parse_number(os.path.splitext(filename)[0], self.pattern)
+        if number is None:
+            self.unnumbered.add(filename)
+            return None
+        return number, _natural_key(filename), filename
+
+    def refresh(self):
+        """Rescan the directory, parsing only filenames not seen before.
+
+        :return: Tuple of sets of added and removed filenames.
+        """
+        if scandir is not None:
+            filenames = set(entry.name for entry in scandir(self.directory)
+                            if entry.is_file())
+        else:
+            filenames = set(name for name in os.listdir(self.directory)
+                            if os.path.isfile(os.path.join(self.directory,
+                                                           name)))
+        filenames = set(name for name in filenames if self._accepts(name))
+        known = set(self._names) | self.unnumbered
+        removed = known - filenames
+        added = filenames - known
+        for filename in removed:
+            self.remove(filename)
+        if len(added) > 64:
+            # Sorting once beats many insertions into a long list
+            for filename in added:
+                key = self._key(filename)
+                if key is not None:
+                    self._names[filename] = key
+                    self._keys.append(key)
+            self._keys.sort()
+        else:
+            for filename in added:
+                self.add(filename)
+        return added, removed
+
+    def add(self, filename):
+        """Add filename to the index.
+
+        :return: The parsed number or None.
+        """
+        if filename in self._names:
+            return self._names[filename][0]
+        key = self._key(filename)
+        if key is None:
+            return None
+        self._names[filename] = key
+        insort(self._keys, key)
+        return key[0]
+
+    def remove(self, filename):
+        """Remove filename from the index if present."""
+        self.unnumbered.discard(filename)
+        key = self._names.pop(filename, None)
+        if key is not None:
+            del self._keys[bisect_left(self._keys, key)]
+
+    def number(self, filename):
+        """The number of an indexed filename or None."""
+        key = self._names.get(filename)
+        return key[0] if key else None
+
+    def find(self, number):
+        """List of filenames numbered number (more than one if duplicated).
+        """
+        return self.range(number, number + 1)
+
+    def range(self, start, stop):
+        """List of filenames numbered from start up to but excluding stop."""
+        low = bisect_left(self._keys, (start,))
+        high = bisect_left(self._keys, (stop,))
+        return [key[2] for key in self._keys[low:high]]
+
+    def numbers(self):
+        """Sorted list of unique numbers."""
+        numbers = []
+        for key in self._keys:
+            if not numbers or numbers[-1] != key[0]:
+                numbers.append(key[0])
+        return numbers
+
+    def ranges(self):
+        """List of (first, last) tuples of consecutively numbered runs."""
+        ranges = []
+        for number in self.numbers():
+            if ranges and ranges[-1][1] == number - 1:
+                ranges[-1] = (ranges[-1][0], number)
+            else:
+                ranges.append((number, number))
+        return ranges
+
+    def gaps(self):
+        """List of (first, last) tuples of missing numbers in the sequence.
+        """
+        ranges = self.ranges()
+        return [(ranges[i][1] + 1, ranges[i + 1][0] - 1)
+                for i in range(len(ranges) - 1)]
+
+    def duplicates(self):
+        """Dict mapping numbers used by several files to their filenames."""
+        duplicates = {}
+        for i in range(1, len(self._keys)):
+            if self._keys[i][0] == self._keys[i - 1][0]:
+                filenames = duplicates.setdefault(self._keys[i][0],
+                                                  [self._keys[i - 1][2]])
+                filenames.append(self._keys[i][2])
+        return duplicates
+
+
+# Backup filenames as created by Py7File.backup: trunc, version, extension
+_BACKUP_RE = re.compile(r'^(.*)_backup_(\d{3,})((?:\.[^.]*)?)$')
+
+
+def _remove_tree(path, dry_run=False):
+    """Remove directory tree at path (unless dry_run).
+
+    :return: Total size of the removed files in bytes.
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            size += os.lstat(file_path).st_size
+            if not dry_run:
+                os.remove(file_path)
+        if not dry_run:
+            for dirname in dirnames:
+                dir_path = os.path.join(dirpath, dirname)
+                if os.path.islink(dir_path):
+                    os.remove(dir_path)
+                else:
+                    os.rmdir(dir_path)
+    if not dry_run:
+        os.rmdir(path)
+    return size
+
+
+class BackupCollector(object):
+
+    """
+    Garbage collector for backups and unzipped folders of whole trees.
+
+    Every directory is listed once. Its ``[trunc]_backup_NNN[.ext]`` files
+    are grouped by the file they are backups of, and retention policies are
+    applied per group, newest backup first. Without any policy all backups
+    are collected, like :meth:`Py7File.cleanup` does for a single file.
+    Backups are only collected while their original exists next to them.
+    ``[trunc]_unzipped`` folders are only collected if a file with that
+    trunc still exists next to them. They are never descended into, their
+    contents belong to the archive even if named like backups.
+
+    :param keep_last: Number of newest backups to keep per file.
+    :param max_age: Collect backups and unzipped folders whose mtime is more
+        than max_age seconds ago.
+    :param max_bytes: Maximum total size of kept backups per file.
+    :param unzipped: Also collect unzipped folders.
+    :param workers: Maximum number of concurrent removals.
+    """
+
+    def __init__(self, keep_last=None, max_age=None, max_bytes=None,
+                 unzipped=True, workers=4):
+        self.keep_last = keep_last
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.unzipped = unzipped
+        self.workers = workers
+
+    def _expired(self, backups, now):
+        """Backups of one file not covered by the retention policies."""
+        if (self.keep_last is None and self.max_age is None and
+                self.max_bytes is None):
+            return list(backups)
+        backups = sorted(backups, reverse=True)
+        kept_bytes = 0
+        for kept, (version, path, file_stat) in enumerate(backups):
+            # Only an unbroken run of the newest backups is kept
+            if ((self.keep_last is not None and kept >= self.keep_last) or
+                    (self.max_age is not None and
+                     now - file_stat.st_mtime > self.max_age) or
+                    (self.max_bytes is not None and
+                     kept_bytes + file_stat.st_size > self.max_bytes)):
+                return backups[kept:]
+            kept_bytes += file_stat.st_size
+        return []
+
+    def find(self, root, now=None):
+        """Yield (kind, path, size) of everything to collect below root.
+
+        Kind is 'backup' or 'unzipped', size is `None` for unzipped folders.
+        """
+        if now is None:
+            now = time.time()
+        pending = [root]
+        while pending:
+            directory = pending.pop()
+            try:
+                entries = _list_dir(directory)
+            except OSError:
+                continue
+            names, truncs = set(), set()
+            groups = {}
+            unzipped = []
+            for name, is_dir, get_stat in entries:
+                path = os.path.join(directory, name)
+                if is_dir:
+                    if not name.endswith('_unzipped'):
+                        pending.append(path)
+                    elif self.unzipped:
+                        unzipped.append((name, path, get_stat))
                     continue
-                file_path = os.path.join(root, file_name)
-                outfile.write(file_path, trim(file_path))
-            # Also add empty directories
-            if not files and not dirs:
-                zip_info = zipfile.ZipInfo(trim(root) + "/")
-                outfile.writestr(zip_info, "")
-        outfile.close()
-        self.delete_zip_folder()
+                names.add(name)
+                truncs.add(os.path.splitext(name)[0])
+                match = _BACKUP_RE.match(name)
+                if match:
+                    try:
+                        file_stat = get_stat()
+                    except OSError:
+                        continue
+                    if not stat.S_ISREG(file_stat.st_mode):
+                        continue
+                    original = match.group(1) + match.group(3)
+                    groups.setdefault(original, []).append(
+                        (int(match.group(2)), path, file_stat))
+            for original in sorted(groups):
+                if original not in names:
+                    # The last copy of a deleted file or a user file that
+                    # only looks like a backup
+                    continue
+                for version, path, file_stat in self._expired(
+                        groups[original], now):
+                    yield 'backup', path, file_stat.st_size
+            for name, path, get_stat in unzipped:
+                if name[:-len('_unzipped')] not in truncs:
+                    continue
+                if self.max_age is not None:
+                    try:
+                        if now - get_stat().st_mtime <= self.max_age:
+                            continue
+                    except OSError:
+                        continue
+                yield 'unzipped', path, None
+
+    def collect(self, root, dry_run=False, now=None):
+        """Remove everything :meth:`find` yields for root.
+
+        :param dry_run: Only report what would be removed.
+        :return: dict with counts of backups and unzipped folders, their
+            total bytes and a list of (path, error) tuples.
+        """
+        report = {'backups': 0, 'unzipped': 0, 'bytes': 0, 'errors': [],
+                  'dry_run': dry_run}
+
+        def remove(item):
+            kind, path, size = item
+            try:
+                if kind == 'unzipped':
+                    size = _remove_tree(path, dry_run)
+                elif not dry_run:
+                    os.remove(path)
+            except OSError as e:
+                return item, str(e)
+            return (kind, path, size), None
+
+        pool = ThreadPool(max(self.workers, 1))
+        try:
+            for (kind, path, size), error in pool.imap_unordered(
+                    remove, self.find(root, now)):
+                if error:
+                    report['errors'].append((path, error))
+                    continue
+                report['backups' if kind == 'backup' else 'unzipped'] += 1
+                report['bytes'] += size
+        finally:
+            pool.close()
+            pool.join()
+        return report
+
+
+def _list_dir(directory):
+    """List (name, is_dir, get_stat) of directory entries in one pass.
+
+    get_stat returns the lstat result, cached by scandir where available.
+    Symlinks are never reported as directories.
+    """
+    if scandir is not None:
+        return [(entry.name, entry.is_dir(follow_symlinks=False),
+                 lambda entry=entry: entry.stat(follow_symlinks=False))
+                for entry in scandir(directory)]
+    entries = []
+    for name in os.listdir(directory):
+        try:
+            file_stat = os.lstat(os.path.join(directory, name))
+        except OSError:
+            continue
+        entries.append((name, stat.S_ISDIR(file_stat.st_mode),
+                        lambda file_stat=file_stat: file_stat))
+    return entries
+
+
+def _is_derived_file(path):
+    """Check if path is a backup or lies inside an unzipped folder."""
+    if _BACKUP_RE.match(os.path.basename(path)):
+        return True
+    dirname = os.path.dirname(path)
+    return any(part.endswith('_unzipped') for part in dirname.split(os.sep))
+
+
+def _open_file(path):
+    """Wrap path in the Py7File subclass matching its extension."""
+    if path.lower().endswith('.epub'):
+        return EpubFile(path)
+    return Py7File(path)
+
+
+def _cli_hash(the_file, args):
+    return {'md5': the_file.get_md5()}
+
+
+def _cli_unzip(the_file, args):
+    unzipped = the_file.unzip(store=args.store)
+    return {'files': [f.filepath for f in unzipped]}
+
+
+def _cli_rezip(the_file, args):
+    the_file.rezip(durable=args.durable, policy=args.policy)
+    return {}
+
+
+def _cli_backup(the_file, args):
+    return {'backup': the_file.backup(durable=args.durable).filepath}
+
+
+def _cli_cleanup(the_file, args):
+    the_file.cleanup()
+    return {}
+
+
+def _cli_sanitize(the_file, args):
+    sanitized = the_file.get_sanitized_filename()
+    if args.rename and sanitized and sanitized != the_file.filename:
+        the_file.move(os.path.join(the_file.location, sanitized))
+    return {'sanitized': sanitized}
+
+
+_CLI_COMMANDS = {
+    'hash': (_cli_hash, 'print MD5 hash of files'),
+    'dedupe': (_cli_hash, 'report groups of files with identical content'),
+    'unzip': (_cli_unzip, 'unzip files to [filename]_unzipped folders'),
+    'rezip': (_cli_rezip, 'rezip [filename]_unzipped folders'),
+    'backup': (_cli_backup, 'create numbered backups of files'),
+    'cleanup': (_cli_cleanup, 'remove backups and unzipped folders'),
+    'gc': (None, 'collect backups and unzipped folders of whole trees by '
+                 'retention policy'),
+    'sanitize': (_cli_sanitize, 'print (or apply) sanitized filenames'),
+}
+
+
+def _cli_paths(paths, skip=None):
+    """Yield file paths from arguments, walking directories.
+
+    Reads newline separated paths from stdin if paths is empty or "-".
+
+    :param skip: Function called with the path relative to a walked
+        directory and the full path. Walked files it returns `True` for are
+        left out, files given as arguments never are.
+    """
+    if not paths or paths == ['-']:
+        paths = (line.rstrip('\r\n') for line in sys.stdin)
+    for path in paths:
+        if not path:
+            continue
+        if os.path.isdir(path):
+            for relpath, file_stat in _walk_stats(path):
+                full_path = os.path.join(path, relpath)
+                if skip is None or not skip(relpath, full_path):
+                    yield full_path
+        else:
+            yield path
+
+
+def _cli_job(job):
+    """Run a command on a single path and time it."""
+    command, path, args = job
+    start = time.time()
+    record = {'path': path}
+    try:
+        the_file = _open_file(path)
+        record['size'] = the_file.get_filesize()
+        record.update(command(the_file, args))
+    except Exception as e:
+        record['error'] = str(e)
+    record['seconds'] = time.time() - start
+    try:
+        json.dumps(record)
+    except ValueError:
+        # Paths that are not valid UTF-8 can not be printed as json as is
+        record = _cli_printable(record)
+        if record['path'] is not path:
+            record['path_escaped'] = path.encode('string_escape')
+    return record
+
+
+def _cli_printable(value):
+    """Value with byte strings that are not valid UTF-8 decoded to text.
+
+    Undecodable bytes are replaced, lists and dicts are converted deeply.
+    """
+    if isinstance(value, bytes):
+        try:
+            value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('utf-8', 'replace')
+    elif isinstance(value, list):
+        return [_cli_printable(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((key, _cli_printable(item))
+                    for key, item in value.items())
+    return value
+
+
+def _cli_gc(args):
+    """Run a :class:`BackupCollector` over every root directory."""
+    collector = BackupCollector(
+        keep_last=args.keep_last, max_bytes=args.max_bytes,
+        max_age=args.max_age_days * 86400
+        if args.max_age_days is not None else None,
+        unzipped=not args.keep_unzipped, workers=args.jobs)
+    status = 0
+    for root in args.paths or ['.']:
+        start = time.time()
+        report = collector.collect(root, dry_run=args.dry_run)
+        report['path'] = root
+        report['seconds'] = time.time() - start
+        if report['errors']:
+            status = 1
+        sys.stdout.write(json.dumps(report, sort_keys=True) + '\n')
+        sys.stdout.flush()
+    return status
+
+
+def _cli_summary(records, elapsed):
+    """Throughput and latency summary for a list of job records."""
+    latencies = sorted(r['seconds'] for r in records)
+    total_bytes = sum(r.get('size', 0) for r in records)
+    summary = {
+        'files': len(records),
+        'errors': len([r for r in records if 'error' in r]),
+        'bytes': total_bytes,
+        'seconds': elapsed,
+        'files_per_second': len(records) / elapsed if elapsed else 0.0,
+        'mb_per_second': total_bytes / elapsed / 1024 / 1024
+        if elapsed else 0.0,
+    }
+    if latencies:
+        summary.update({
+            'latency_mean': sum(latencies) / len(latencies),
+            'latency_p50': latencies[len(latencies) // 2],
+            'latency_p95': latencies[int(len(latencies) * 0.95)],
+            'latency_max': latencies[-1],
+        })
+    return summary
+
+
+def main(argv=None):
+    """Command line interface, run as ``python -m py7file``.
+
+    Results are printed as one json object per line to stdout, a summary
+    is printed to stderr.
+
+    :return: Exit status, 1 if any file failed.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='py7file', description='Bulk file operations with py7file.')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of parallel workers (default: 4)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print the summary')
+    parser.add_argument('--durable', action='store_true',
+                        help='fsync written files (rezip, backup)')
+    subparsers = parser.add_subparsers(dest='command')
+    for name in sorted(_CLI_COMMANDS):
+        subparser = subparsers.add_parser(name, help=_CLI_COMMANDS[name][1])
+        if name == 'gc':
+            subparser.add_argument('paths', nargs='*', metavar='path',
+                                   help='root directories (default: .)')
+        else:
+            subparser.add_argument('paths', nargs='*', metavar='path',
+                                   help='files or directories, "-" or none '
+                                        'to read paths from stdin')
+        if name == 'unzip':
+            subparser.add_argument('--store', default=None,
+                                   help='content store directory to link '
+                                        'identical members from')
+        elif name == 'rezip':
+            subparser.add_argument('--level', type=int, default=None,
+                                   help='zlib level 1 (fast) to 9 (small)')
+        elif name == 'sanitize':
+            subparser.add_argument('--rename', action='store_true',
+                                   help='rename files to sanitized names')
+        elif name == 'gc':
+            subparser.add_argument('--keep-last', type=int, default=None,
+                                   help='newest backups to keep per file')
+            subparser.add_argument('--max-age-days', type=float,
+                                   default=None,
+                                   help='collect backups and unzipped '
+                                        'folders older than this')
+            subparser.add_argument('--max-bytes', type=int, default=None,
+                                   help='maximum size of kept backups per '
+                                        'file')
+            subparser.add_argument('--keep-unzipped', action='store_true',
+                                   help='do not collect unzipped folders')
+            subparser.add_argument('--dry-run', action='store_true',
+                                   help='only report reclaimable bytes')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error('a command is required')
+    if args.command == 'gc':
+        if (args.keep_last is None and args.max_age_days is None and
+                args.max_bytes is None):
+            parser.error('gc needs --keep-last, --max-age-days or '
+                         '--max-bytes')
+        return _cli_gc(args)
+    command = _CLI_COMMANDS[args.command][0]
+    if args.command == 'rezip':
+        # Shared between workers to collect stats of all archives
+        args.policy = CompressionPolicy(level=args.level)
+    elif args.command == 'unzip' and args.store:
+        args.store = ContentStore(args.store)
+
+    # Backups and unzipped files found by walking are managed through their
+    # originals, these commands create and remove them during the walk
+    skip = None
+    if args.command == 'rezip':
+        skip = lambda relpath, path: (_is_derived_file(relpath) or
+                                      not os.path.isdir(os.path.splitext(
+                                          path)[0] + '_unzipped'))
+    elif args.command in ('backup', 'cleanup', 'unzip'):
+        skip = lambda relpath, path: _is_derived_file(relpath)
+    paths = _cli_paths(args.paths, skip)
+    if args.command == 'dedupe':
+        # Only files sharing their size with another file need hashing
+        by_size = {}
+        for path in paths:
+            try:
+                by_size.setdefault(os.path.getsize(path), []).append(path)
+            except OSError:
+                continue
+        paths = [p for group in by_size.values() if len(group) > 1
+                 for p in group]
+
+    records = []
+    start = time.time()
+    pool = ThreadPool(max(args.jobs, 1))
+    try:
+        jobs = ((command, path, args) for path in paths)
+        for record in pool.imap_unordered(_cli_job, jobs):
+            records.append(record)
+            if args.command != 'dedupe':
+                sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+                sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    if args.command == 'dedupe':
+        groups = {}
+        for record in records:
+            if 'error' in record:
+                sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+                continue
+            key = (record['size'], record['md5'])
+            groups.setdefault(key, []).append(record['path'])
+        for (size, md5), group in sorted(groups.items()):
+            if len(group) > 1:
+                sys.stdout.write(json.dumps(
+                    {'md5': md5, 'size': size, 'paths': sorted(group)},
+                    sort_keys=True) + '\n')
+        sys.stdout.flush()
+
+    summary = _cli_summary(records, time.time() - start)
+    if args.command == 'rezip':
+        summary['compression'] = args.policy.report()
+    elif args.command == 'unzip' and args.store:
+        summary['store'] = dict(args.store.stats)
+    if not args.quiet:
+        sys.stderr.write(json.dumps(summary, sort_keys=True) + '\n')
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
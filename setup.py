@@ -31,5 +31,8 @@ setup(name='py7file',
     author_email='tp@py7.de',
     url='http://github.com/titusz/py7file',
     license='BSD',
-    py_modules=['py7file']
+    py_modules=['py7file'],
+    entry_points={
+        'console_scripts': ['py7file = py7file:main'],
+    }
 )
@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
+import bz2
 import codecs
+import errno
 from gzip import GzipFile
 import os
-from py7file import Py7File, EpubFile
+import json
+import random
+import shutil
+import sys
+import tempfile
+from StringIO import StringIO
+import py7file
+from py7file import (Py7File, EpubFile, BackupCollector, CompressionPolicy,
+                     ContentStore, EpubIndex, FsyncBatch, IOPolicy,
+                     SequenceIndex, TreeSnapshot, index_library, main)
 import zipfile
 try:
     import unittest2 as unittest
@@ -140,6 +151,117 @@ class Py7FileTest(unittest.TestCase):
         # cleanup
         new_file.delete()
 
+    def test_copy_durable(self):
+        test_file = Py7File(self.test_file)
+        new_file = test_file.copy('test_copy.txt', durable=True)
+        self.assertEqual(test_file, new_file)
+        with FsyncBatch() as batch:
+            test_file.copy('test_copy.txt', secure=False, durable=batch)
+            self.assertEqual(len(batch), 2)
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(test_file, new_file)
+        self.assertFalse([f for f in os.listdir(self.root)
+                          if f.endswith('.tmp')])
+        new_file.delete()
+
+    def test_copy_to_dir(self):
+        test_file = Py7File(self.test_file)
+        new_file = test_file.copy(os.path.join(self.root, 'test'))
+        self.assertEqual(new_file.location, os.path.join(self.root, 'test'))
+        self.assertEqual(new_file.filename, test_file.filename)
+        new_file.delete()
+
+    def test_sync_to(self):
+        source = os.path.join(self.root, 'sync_source.bin')
+        dest = os.path.join(self.root, 'sync_dest.bin')
+        manifest = os.path.join(self.root, 'sync_dest.manifest')
+        with open(source, 'wb') as source_file:
+            source_file.write(b'0123456789abcdef')
+        the_file = Py7File(source)
+        synced = the_file.sync_to(dest, block_size=4, manifest=manifest)
+        self.assertEqual(the_file, synced)
+        # modify and shrink
+        with open(source, 'wb') as source_file:
+            source_file.write(b'0123XXXX89ab')
+        the_file.sync_to(dest, block_size=4, manifest=manifest)
+        self.assertEqual(the_file, synced)
+        # grow without manifest
+        with open(source, 'wb') as source_file:
+            source_file.write(b'0123XXXX89abcdefgh')
+        the_file.sync_to(dest, block_size=4)
+        self.assertEqual(the_file, synced)
+        # a stale manifest is detected and ignored, whole seconds survive
+        # the float round trip of os.utime on python 2 exactly
+        os.utime(dest, (1000000000, 1000000000))
+        the_file.sync_to(dest, block_size=4, manifest=manifest)
+        self.assertEqual(the_file, synced)
+        with open(manifest, 'rb') as manifest_file:
+            self.assertEqual(json.loads(manifest_file.read())['mtime_ns'],
+                             1000000000 * 1000000000)
+        # a valid manifest is trusted without reading dest, even after a
+        # change by a tool that preserves the mtime
+        stat = os.stat(dest)
+        with open(dest, 'r+b') as dest_file:
+            dest_file.write(b'YYYY')
+        os.utime(dest, (stat.st_atime, stat.st_mtime))
+        the_file.sync_to(dest, block_size=4, manifest=manifest)
+        self.assertNotEqual(the_file, synced)
+        for path in source, dest, manifest:
+            os.remove(path)
+
+    def test_copy_resumable(self):
+        the_file = Py7File(self.test_file)
+        the_file.checkpoint_size = 4
+        dest = os.path.join(self.root, 'resumed.txt')
+        part = os.path.join(self.root, '.resumed.txt.part')
+        copy_segment = py7file._copy_segment
+        written = []
+        fail_at = [3]
+
+        def interrupted(src, dst, size):
+            if dst is not None and len(written) == fail_at[0]:
+                raise IOError('Disk unplugged')
+            result = copy_segment(src, dst, size)
+            if dst is not None:
+                written.append(result[1])
+            return result
+        py7file._copy_segment = interrupted
+        try:
+            self.assertRaises(IOError, the_file.copy, dest, resumable=True)
+            self.assertTrue(os.path.isfile(part))
+            self.assertTrue(os.path.isfile(part + '.json'))
+            self.assertFalse(os.path.isfile(dest))
+            del written[:]
+            fail_at[0] = None
+            the_file.copy(dest, resumable=True)
+        finally:
+            py7file._copy_segment = copy_segment
+        # 26 bytes with 12 copied before the interruption
+        self.assertEqual(sum(written), 14)
+        self.assertEqual(the_file, dest)
+        self.assertFalse(os.path.isfile(part))
+        self.assertFalse(os.path.isfile(part + '.json'))
+        os.remove(dest)
+
+    def test_move_cross_device(self):
+        file_to_move = self.test_object.copy('file_to_move.txt')
+        rename = os.rename
+
+        def cross_device_rename(src, dst):
+            if src == file_to_move.filepath:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            rename(src, dst)
+        py7file.os.rename = cross_device_rename
+        try:
+            moved_file = file_to_move.move('moved_file.txt')
+        finally:
+            py7file.os.rename = rename
+        self.assertTrue(moved_file is file_to_move)
+        self.assertEqual(moved_file.filename, 'moved_file.txt')
+        self.assertEqual(moved_file, self.test_file)
+        self.assertFalse(os.path.isfile('file_to_move.txt'))
+        moved_file.delete()
+
     def test_move(self):
         file_to_move = self.test_object.copy('file_to_move.txt')
         moved_file = file_to_move.move('moved_file.txt')
@@ -175,6 +297,46 @@ class Py7FileTest(unittest.TestCase):
         self.assertTrue(isinstance(hash, str))
         self.assertEqual(len(hash), 32)
 
+    def test_io_policy(self):
+        calls = []
+        fadvise, readahead = py7file._fadvise, py7file._readahead
+        py7file._fadvise = lambda fd, o, l, advice: calls.append(
+            ('fadvise', o, l, advice))
+        py7file._readahead = lambda fd, o, l: calls.append(('readahead', o, l))
+        try:
+            policy = IOPolicy(willneed=True, readahead=32, drop_behind=True)
+            policy.drop_size = 10
+            the_file = Py7File(self.test_file)
+            self.assertEqual(the_file.get_md5(io_policy=policy),
+                             the_file.get_md5(io_policy=IOPolicy()))
+            self.assertEqual(the_file.read(io_policy=policy),
+                             'This is a file for testing')
+        finally:
+            py7file._fadvise, py7file._readahead = fadvise, readahead
+        self.assertIn(('fadvise', 0, 0, py7file.POSIX_FADV_SEQUENTIAL), calls)
+        self.assertIn(('fadvise', 0, 0, py7file.POSIX_FADV_WILLNEED), calls)
+        self.assertIn(('readahead', 0, 32), calls)
+        self.assertIn(('fadvise', 0, 26, py7file.POSIX_FADV_DONTNEED), calls)
+
+    def test_io_policy_lines(self):
+        with open('lines.txt', 'wb') as the_file:
+            the_file.write(b'one\r\ntwo\n' * 4)
+        calls = []
+        fadvise = py7file._fadvise
+        py7file._fadvise = lambda fd, o, l, advice: calls.append((o, l))
+        try:
+            policy = IOPolicy(drop_behind=True)
+            policy.drop_size = 10
+            with policy.open('lines.txt') as the_file:
+                lines = list(the_file)
+        finally:
+            py7file._fadvise = fadvise
+            os.remove('lines.txt')
+        self.assertEqual(lines, [b'one\r\n', b'two\n'] * 4)
+        # iterating drops behind as the lines are read, not only on close
+        self.assertIn((0, 14), calls)
+        self.assertRaises(ValueError, policy.open, self.test_file, 'w')
+
     def test_get_filesize(self):
         the_file = Py7File(self.test_file)
         self.assertTrue(the_file.get_filesize())
@@ -189,6 +351,89 @@ class Py7FileTest(unittest.TestCase):
         self.assertTrue(os.path.exists(self.test_file_zip))
         self.assertFalse(os.path.isdir('zip_test_unzipped'))
 
+    def test_rezip_failure_keeps_original(self):
+        the_epub = EpubFile(self.test_epub)
+        copied_epub = the_epub.copy(os.path.join(self.root, 'test', 'test_copy.epub'))
+        copied_epub.unzip()
+        os.remove(os.path.join(copied_epub.zipdir, 'mimetype'))
+        self.assertRaises((IOError, OSError), copied_epub.rezip)
+        self.assertEqual(the_epub, copied_epub)
+        self.assertFalse([f for f in os.listdir(copied_epub.location)
+                          if f.endswith('.tmp')])
+        copied_epub.cleanup()
+        copied_epub.delete()
+
+    def test_rezip_policy(self):
+        the_file = Py7File(self.test_file_zip)
+        the_file.unzip()
+        with open(os.path.join(the_file.zipdir, 'photo.jpg'), 'wb') as jpg:
+            jpg.write(b'\xff\xd8' + b'\0' * 1000)
+        with open(os.path.join(the_file.zipdir, 'noise.bin'), 'wb') as noise:
+            noise.write(os.urandom(1000))
+        with open(os.path.join(the_file.zipdir, 'text.txt'), 'w') as text:
+            text.write('compress me ' * 100)
+        policy = CompressionPolicy(level=1)
+        the_file.rezip(policy=policy)
+        zip_file = zipfile.ZipFile(self.test_file_zip)
+        types = dict((i.filename.lstrip('/'), i.compress_type)
+                     for i in zip_file.infolist())
+        zip_file.close()
+        self.assertEqual(types['photo.jpg'], zipfile.ZIP_STORED)
+        self.assertEqual(types['noise.bin'], zipfile.ZIP_STORED)
+        self.assertEqual(types['text.txt'], zipfile.ZIP_DEFLATED)
+        report = policy.report()
+        self.assertEqual(report['jpg']['stored'], 1)
+        self.assertEqual(report['txt']['members'], 3)
+        self.assertTrue(report['txt']['saved'] > 1000)
+
+    def test_compression_level(self):
+        words = random.Random(0)
+        with open('level.txt', 'w') as text:
+            text.write(' '.join(str(words.randint(0, 5000))
+                                for i in range(20000)))
+        sizes = {}
+        try:
+            for level in (1, 9):
+                with zipfile.ZipFile('level.zip', 'w') as zip_file:
+                    CompressionPolicy(level=level).write(
+                        zip_file, 'level.txt', 'level.txt')
+                with zipfile.ZipFile('level.zip') as zip_file:
+                    self.assertIsNone(zip_file.testzip())
+                    with open('level.txt', 'rb') as text:
+                        self.assertEqual(zip_file.read('level.txt'),
+                                         text.read())
+                    sizes[level] = zip_file.getinfo('level.txt').compress_size
+        finally:
+            for name in ('level.txt', 'level.zip'):
+                if os.path.exists(name):
+                    os.remove(name)
+        self.assertLess(sizes[9], sizes[1])
+        self.assertRaises(ValueError, CompressionPolicy, level=0)
+
+    def test_compression_level_members(self):
+        name = u'b\xfccher.txt'
+        policy = CompressionPolicy(level=9)
+        try:
+            for path, content in (('empty.txt', ''),
+                                  ('text.txt', 'text ' * 50)):
+                with open(path, 'w') as the_file:
+                    the_file.write(content)
+            with zipfile.ZipFile('level.zip', 'w') as zip_file:
+                policy.write(zip_file, 'empty.txt', 'empty.txt')
+                policy.write(zip_file, 'text.txt', name)
+            with zipfile.ZipFile('level.zip') as zip_file:
+                self.assertIsNone(zip_file.testzip())
+                self.assertEqual(zip_file.namelist(), ['empty.txt', name])
+                self.assertEqual(zip_file.read('empty.txt'), b'')
+                self.assertEqual(zip_file.read(name), b'text ' * 50)
+                self.assertEqual(zip_file.getinfo(name).compress_type,
+                                 zipfile.ZIP_DEFLATED)
+        finally:
+            for path in ('empty.txt', 'text.txt', 'level.zip'):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.assertIn('wall_seconds', policy.report()['txt'])
+
     def test_unzip_noext(self):
         the_file = Py7File(self.test_file_zip_noext)
         the_file.unzip()
@@ -215,6 +460,29 @@ class Py7FileTest(unittest.TestCase):
         self.assertIn('gz_test.txt', filenames)
         the_file.cleanup()
 
+    def test_open_decompressed(self):
+        gz_file = Py7File(self.test_file_gz).open_decompressed()
+        self.assertEqual(gz_file.read(), 'Test content for gzipped text file')
+        gz_file.close()
+        zip_file = Py7File(self.test_file_zip)
+        self.assertRaises(ValueError, zip_file.open_decompressed)
+        member = zip_file.open_decompressed('subfolder/file_in_subfolder.txt')
+        self.assertEqual(member.read(), 'just a testfile')
+        member.close()
+        self.assertRaises(IOError, Py7File(self.test_file).open_decompressed)
+
+    def test_iter_decompressed(self):
+        chunks = list(Py7File(self.test_file_gz).iter_decompressed(4))
+        self.assertEqual(len(chunks[0]), 4)
+        self.assertEqual(''.join(chunks), 'Test content for gzipped text file')
+        bz2_path = os.path.join(self.root, 'bz2_test.txt.bz2')
+        bz2_file = bz2.BZ2File(bz2_path, 'w')
+        bz2_file.write('Test content for bzipped text file')
+        bz2_file.close()
+        chunks = Py7File(bz2_path).iter_decompressed()
+        self.assertEqual(''.join(chunks), 'Test content for bzipped text file')
+        os.remove(bz2_path)
+
     def test_special_chars(self):
         the_file = Py7File(self.test_file_utf8)
         the_file.backup()
@@ -254,6 +522,67 @@ class Py7FileTest(unittest.TestCase):
         self.assertFalse(Py7File(self.test_file).is_zip_file())
         self.assertFalse(Py7File(self.test_file_utf16).is_zip_file())
 
+    def test_verify_archive(self):
+        self.assertEqual(Py7File(self.test_file_zip).verify_archive(), [])
+        self.assertEqual(EpubFile(self.test_epub).verify_archive(workers=4), [])
+        self.assertEqual(Py7File(self.test_file_gz).verify_archive(), [])
+        self.assertEqual(Py7File(self.test_file).verify_archive(),
+                         [(None, 'not an archive')])
+        # mimetype is not first
+        problems = Py7File(self.test_file_zip).verify_archive(
+            check_layout=True)
+        self.assertEqual(problems[0][0], 'mimetype')
+
+    def test_verify_archive_corrupt(self):
+        path = os.path.join(self.root, 'corrupt.zip')
+        zip_file = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+        zip_file.writestr('good.txt', 'all fine here')
+        zip_file.writestr('bad.txt', 'soon to be corrupted')
+        zip_file.writestr('../evil.txt', 'escaping')
+        zip_file.close()
+        with open(path, 'rb') as the_file:
+            data = the_file.read()
+        with open(path, 'wb') as the_file:
+            the_file.write(data.replace(b'corrupted', b'CORRUPTED'))
+        problems = Py7File(path).verify_archive(workers=2)
+        self.assertEqual([p[0] for p in problems], ['../evil.txt', 'bad.txt'])
+        self.assertEqual(len(Py7File(path).verify_archive(fail_fast=True)), 1)
+        os.remove(path)
+        # a corrupt mimetype is reported, not raised from the layout check
+        zip_file = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+        zip_file.writestr('mimetype', 'application/epub+zip')
+        zip_file.writestr('META-INF/container.xml', '<container/>')
+        zip_file.close()
+        with open(path, 'rb') as the_file:
+            data = the_file.read()
+        with open(path, 'wb') as the_file:
+            the_file.write(data.replace(b'epub+zip', b'EPUB+ZIP', 1))
+        problems = Py7File(path).verify_archive(check_layout=True)
+        self.assertEqual([p[0] for p in problems], ['mimetype'])
+        self.assertIn('CRC', problems[0][1])
+        os.remove(path)
+
+    def test_verify_archive_bomb(self):
+        path = os.path.join(self.root, 'bomb.zip')
+        zip_file = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        zip_file.writestr('zeros.bin', b'\0' * 4 * 1024 * 1024)
+        zip_file.close()
+        problems = Py7File(path).verify_archive()
+        self.assertEqual(problems[0][0], 'zeros.bin')
+        self.assertEqual(Py7File(path).verify_archive(max_ratio=10000), [])
+        problems = Py7File(path).verify_archive(max_ratio=10000,
+                                                max_size=1024)
+        self.assertTrue(problems)
+        os.remove(path)
+
+    def test_verify_archive_gz_trailer(self):
+        with open(self.test_file_gz, 'rb') as the_file:
+            data = the_file.read()
+        with open(self.test_file_gz, 'wb') as the_file:
+            the_file.write(data[:-8] + b'\0' * 8)
+        problems = Py7File(self.test_file_gz).verify_archive()
+        self.assertEqual(len(problems), 1)
+
     def test_read(self):
         self.assertIsInstance(Py7File(self.test_file).read(), str)
         self.assertEqual(Py7File(self.test_file).read(), 'This is a file for testing')
@@ -282,12 +611,464 @@ class Py7FileTest(unittest.TestCase):
         self.assertTrue(zipfile.is_zipfile(copied_file.filepath))
         copied_file.delete()
 
+    def test_epub_metadata(self):
+        metadata = EpubFile(self.test_epub).metadata
+        self.assertEqual(metadata['title'], 'Test ePub')
+        self.assertEqual(metadata['authors'], ['Titusz'])
+        self.assertEqual(metadata['identifier'],
+                         'urn:uuid:67e1e5e6-13e7-42d3-bbf1-bac0e1248e5d')
+        self.assertEqual(metadata['language'], 'en')
+        self.assertEqual(metadata['spine'], ['OEBPS/Text/Section0001.xhtml'])
+
     def test_get_number(self):
         test_file_no_num = Py7File(self.test_file)
         self.assertIsNone(test_file_no_num.get_number())
         test_file_numbered = Py7File(self.numbered_file)
         self.assertIsInstance(test_file_numbered.get_number(), int)
         self.assertEqual(test_file_numbered.get_number(), 26)
+        self.assertEqual(test_file_numbered.get_number(r'test_(\d{2})'), 0)
+        page = test_file_numbered.copy('v2_page010.txt')
+        self.assertEqual(page.get_number(), 10)
+        page.delete()
+
+
+
+class TreeSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'sub'))
+        for name, content in (('keep.txt', 'unchanged'),
+                              ('modify.txt', 'before'),
+                              ('remove.txt', 'gone soon'),
+                              ('rename.txt', 'moving around'),
+                              ('sub/copy.txt', 'copied and deleted')):
+            with open(os.path.join(self.root, name), 'w') as the_file:
+                the_file.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def change_tree(self):
+        with open(os.path.join(self.root, 'modify.txt'), 'w') as the_file:
+            the_file.write('after the change')
+        with open(os.path.join(self.root, 'added.txt'), 'w') as the_file:
+            the_file.write('new')
+        os.remove(os.path.join(self.root, 'remove.txt'))
+        os.rename(os.path.join(self.root, 'rename.txt'),
+                  os.path.join(self.root, 'sub', 'renamed.txt'))
+        shutil.copy(os.path.join(self.root, 'sub', 'copy.txt'),
+                    os.path.join(self.root, 'copied.txt'))
+        os.remove(os.path.join(self.root, 'sub', 'copy.txt'))
+
+    def test_scan(self):
+        snapshot = TreeSnapshot.scan(self.root, digest=True)
+        self.assertEqual(len(snapshot), 5)
+        self.assertIn(os.path.join('sub', 'copy.txt'), snapshot.entries)
+        md5 = Py7File(os.path.join(self.root, 'keep.txt')).get_md5()
+        self.assertEqual(snapshot.entries['keep.txt'][3], md5)
+
+    def test_save_load(self):
+        snapshot = TreeSnapshot.scan(self.root, digest=True)
+        path = os.path.join(self.root, 'snapshot.gz')
+        snapshot.save(path)
+        loaded = TreeSnapshot.load(path)
+        self.assertEqual(loaded.root, snapshot.root)
+        self.assertEqual(loaded.entries, snapshot.entries)
+
+    def test_diff(self):
+        before = TreeSnapshot.scan(self.root, digest=True)
+        self.change_tree()
+        after = TreeSnapshot.scan(self.root, digest=True, previous=before)
+        changes = after.diff(before)
+        self.assertEqual(changes.added, ['added.txt'])
+        self.assertEqual(changes.removed, ['remove.txt'])
+        self.assertEqual(changes.modified, ['modify.txt'])
+        self.assertEqual(changes.renamed,
+                         [('sub/copy.txt', 'copied.txt'),
+                          ('rename.txt', 'sub/renamed.txt')])
+
+    def test_diff_without_digest(self):
+        before = TreeSnapshot.scan(self.root)
+        self.change_tree()
+        changes = TreeSnapshot.scan(self.root).diff(before)
+        self.assertEqual(changes.added, ['added.txt', 'copied.txt'])
+        self.assertEqual(changes.removed, ['remove.txt', 'sub/copy.txt'])
+        self.assertEqual(changes.modified, ['modify.txt'])
+        self.assertEqual(changes.renamed, [('rename.txt', 'sub/renamed.txt')])
+
+
+
+class EpubIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.epub = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'test', 'test.epub')
+        os.mkdir(os.path.join(self.root, 'sub'))
+        for name in ('one.epub', 'sub/two.epub'):
+            shutil.copy(self.epub, os.path.join(self.root, name))
+        with open(os.path.join(self.root, 'broken.epub'), 'w') as broken:
+            broken.write('not a zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_index_library(self):
+        index = index_library(self.root, workers=2)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(len(index.errors()), 1)
+        books = index.search(author='titu', title='test')
+        self.assertEqual(len(books), 2)
+        self.assertEqual(books[0]['authors'], ['Titusz'])
+        book = index.get(os.path.join(self.root, 'one.epub'))
+        self.assertEqual(book['language'], 'en')
+        self.assertRaises(ValueError, index.search, isbn='123')
+        index.close()
+
+    def test_update(self):
+        index = EpubIndex(':memory:')
+        counts = index.update(self.root)
+        self.assertEqual((counts['added'], counts['failed']), (2, 1))
+        os.remove(os.path.join(self.root, 'one.epub'))
+        shutil.copy(self.epub, os.path.join(self.root, 'three.epub'))
+        counts = index.update(self.root)
+        self.assertEqual(counts['added'], 1)
+        self.assertEqual(counts['removed'], 1)
+        self.assertEqual(counts['unchanged'], 2)
+        self.assertEqual(counts['updated'], 0)
+        index.close()
+
+    def test_non_ascii_path(self):
+        name = u'b\xfccher.epub'.encode(sys.getfilesystemencoding())
+        shutil.copy(self.epub, os.path.join(self.root, name))
+        index = index_library(self.root)
+        self.assertEqual(len(index), 4)
+        book = index.get(os.path.join(self.root, name))
+        self.assertEqual(book['path'], os.path.join(
+            unicode(self.root, sys.getfilesystemencoding()), u'b\xfccher.epub'))
+        self.assertEqual(index.update(self.root)['unchanged'], 4)
+        index.close()
+
+
+class ContentStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.zips = []
+        for name in ('one', 'two'):
+            path = os.path.join(self.root, name + '.zip')
+            zip_file = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+            zip_file.writestr('fonts/shared.otf', 'the same font ' * 100)
+            zip_file.writestr('text.txt', 'text of book ' + name)
+            zip_file.close()
+            self.zips.append(Py7File(path))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_unzip_hardlinked(self):
+        store = ContentStore(os.path.join(self.root, 'store'),
+                             link='hardlink')
+        for the_file in self.zips:
+            self.assertEqual(len(the_file.unzip(store=store)), 2)
+        shared = [os.path.join(z.zipdir, 'fonts', 'shared.otf')
+                  for z in self.zips]
+        self.assertEqual(os.stat(shared[0]).st_ino, os.stat(shared[1]).st_ino)
+        self.assertNotEqual(
+            os.stat(os.path.join(self.zips[0].zipdir, 'text.txt')).st_ino,
+            os.stat(os.path.join(self.zips[1].zipdir, 'text.txt')).st_ino)
+        # members of the first book become blobs, the second links the font
+        self.assertEqual(store.stats['stored'], 3)
+        self.assertEqual(store.stats['linked'], 1)
+        self.assertEqual(store.stats['saved'], 1400)
+        with open(shared[1]) as font:
+            self.assertEqual(font.read(), 'the same font ' * 100)
+        # unzipping again must not write through the links
+        self.zips[0].unzip(store=store)
+        self.assertEqual(os.path.getsize(shared[1]), 1400)
+
+        store.detach(shared[0])
+        with open(shared[0], 'w') as font:
+            font.write('edited')
+        with open(shared[1]) as font:
+            self.assertEqual(font.read(), 'the same font ' * 100)
+
+        self.zips[0].rezip()
+        self.zips[1].rezip()
+        self.assertEqual(store.prune(), 1400 + 2 * 16)
+        self.assertEqual(Py7File(self.zips[0].filepath).verify_archive(), [])
+
+    def test_unzip_auto_never_hardlinks(self):
+        store = ContentStore(os.path.join(self.root, 'store'))
+        for the_file in self.zips:
+            the_file.unzip(store=store)
+        shared = [os.path.join(z.zipdir, 'fonts', 'shared.otf')
+                  for z in self.zips]
+        self.assertEqual(os.stat(shared[0]).st_nlink, 1)
+        # only reflinks save space, without them nothing is stored twice
+        self.assertEqual(store.stats['saved'], 1400 * store.stats['linked'])
+        if not store.stats['stored']:
+            self.assertEqual(store.stats['copied'], 4)
+            self.assertEqual(list(py7file._walk_stats(store.path)), [])
+        with open(shared[0], 'w') as font:
+            font.write('edited')
+        with open(shared[1]) as font:
+            self.assertEqual(font.read(), 'the same font ' * 100)
+
+
+class SequenceIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name in ('v2_page001.tif', 'v2_page002.tif', 'v2_page010.tif',
+                     'v2_page9.tif', 'v2_page005.tif', 'v2_page05.tif',
+                     'cover.tif', 'v2_page003.txt'):
+            open(os.path.join(self.root, name), 'w').close()
+        os.mkdir(os.path.join(self.root, 'v2_page004'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_order(self):
+        index = SequenceIndex(self.root, extensions=['tif'])
+        self.assertEqual(list(index), [
+            'v2_page001.tif', 'v2_page002.tif', 'v2_page005.tif',
+            'v2_page05.tif', 'v2_page9.tif', 'v2_page010.tif'])
+        self.assertEqual(index[-1], 'v2_page010.tif')
+        self.assertEqual(index.unnumbered, set(['cover.tif']))
+        self.assertEqual(index.number('v2_page9.tif'), 9)
+
+    def test_gaps_ranges_duplicates(self):
+        index = SequenceIndex(self.root, extensions=['.tif'])
+        self.assertEqual(index.ranges(), [(1, 2), (5, 5), (9, 10)])
+        self.assertEqual(index.gaps(), [(3, 4), (6, 8)])
+        self.assertEqual(index.duplicates(),
+                         {5: ['v2_page005.tif', 'v2_page05.tif']})
+
+    def test_lookup(self):
+        index = SequenceIndex(self.root, pattern=r'page(\d+)')
+        self.assertEqual(index.find(3), ['v2_page003.txt'])
+        self.assertEqual(index.find(4), [])
+        self.assertEqual(index.range(2, 6), [
+            'v2_page002.tif', 'v2_page003.txt', 'v2_page005.tif',
+            'v2_page05.tif'])
+
+    def test_refresh(self):
+        index = SequenceIndex(self.root, extensions=['tif'])
+        os.remove(os.path.join(self.root, 'v2_page05.tif'))
+        open(os.path.join(self.root, 'v2_page004.tif'), 'w').close()
+        added, removed = index.refresh()
+        self.assertEqual(added, set(['v2_page004.tif']))
+        self.assertEqual(removed, set(['v2_page05.tif']))
+        self.assertEqual(index.ranges(), [(1, 2), (4, 5), (9, 10)])
+        self.assertEqual(index.duplicates(), {})
+
+
+class BackupCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.now = 1000000000
+        os.mkdir(os.path.join(self.root, 'sub'))
+        for name in ('a.txt', 'sub/b', 'c.zip'):
+            self.write(name, 'original')
+        # five backups of a.txt, one day apart with growing size
+        for version in range(1, 6):
+            self.write('a_backup_{0:03d}.txt'.format(version), 'x' * version,
+                       age=(6 - version) * 86400)
+        self.write('sub/b_backup_001', 'backup of b')
+        self.write('c_unzipped/member.txt', 'extracted')
+        self.write('orphan_unzipped/member.txt', 'no archive')
+        self.write('orphan_unzipped/d_backup_001.txt', 'nested')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, content, age=0):
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as the_file:
+            the_file.write(content)
+        os.utime(path, (self.now - age, self.now - age))
+
+    def found(self, collector):
+        return sorted(os.path.relpath(path, self.root) for kind, path, size
+                      in collector.find(self.root, now=self.now))
+
+    def test_collect_all(self):
+        report = BackupCollector().collect(self.root, now=self.now)
+        self.assertEqual(report['backups'], 6)
+        self.assertEqual(report['unzipped'], 1)
+        self.assertEqual(report['bytes'], 15 + 11 + 9)
+        self.assertEqual(report['errors'], [])
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         ['a.txt', 'c.zip', 'orphan_unzipped', 'sub'])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.root, 'orphan_unzipped'))),
+            ['d_backup_001.txt', 'member.txt'])
+
+    def test_dry_run(self):
+        report = BackupCollector().collect(self.root, dry_run=True)
+        self.assertEqual(report['bytes'], 15 + 11 + 9)
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'c_unzipped')))
+        self.assertEqual(len(os.listdir(self.root)), 10)
+
+    def test_retention(self):
+        self.assertEqual(self.found(BackupCollector(keep_last=2,
+                                                    unzipped=False)), [
+            'a_backup_001.txt', 'a_backup_002.txt', 'a_backup_003.txt'])
+        self.assertEqual(self.found(BackupCollector(max_age=2.5 * 86400)), [
+            'a_backup_001.txt', 'a_backup_002.txt', 'a_backup_003.txt'])
+        self.assertEqual(self.found(BackupCollector(max_bytes=10,
+                                                    unzipped=False)), [
+            'a_backup_001.txt', 'a_backup_002.txt', 'a_backup_003.txt',
+            os.path.join('sub', 'b_backup_001')])
+
+    def test_unzipped_members_are_kept(self):
+        self.write('c_unzipped/e_backup_001.txt', 'member of c',
+                   age=2 * 86400)
+        for collector in (BackupCollector(unzipped=False),
+                          BackupCollector(max_age=86400)):
+            self.assertEqual([p for p in self.found(collector)
+                              if '_unzipped' in p], [])
+
+    def test_cli(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            status = main(['gc', '--keep-last', '1', '--dry-run', self.root])
+            report = json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(status, 0)
+        self.assertEqual(report['backups'], 4)
+        self.assertEqual(report['unzipped'], 1)
+        self.assertTrue(report['dry_run'])
+
+    def test_cli_max_age_zero(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            main(['gc', '--keep-last', '3', '--max-age-days', '0',
+                  '--dry-run', self.root])
+            report = json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+        # an age of 0 collects everything older than now, not nothing
+        self.assertEqual(report['backups'], 6)
+
+    def test_cli_needs_policy(self):
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(SystemExit, main, ['gc', self.root])
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(len(os.listdir(self.root)), 10)
+
+    def test_orphans_are_kept(self):
+        self.write('db_backup_20240101.sql', 'a dump')
+        self.write('notes_backup_001.txt', 'last copy of deleted notes')
+        report = BackupCollector().collect(self.root, now=self.now)
+        self.assertEqual(report['backups'], 6)
+        for name in ('db_backup_20240101.sql', 'notes_backup_001.txt'):
+            self.assertTrue(os.path.exists(os.path.join(self.root, name)))
+
+
+class CliTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name, content in (('a.txt', 'same'), ('b.txt', 'same'),
+                              ('c.txt', 'other')):
+            with open(os.path.join(self.root, name), 'w') as the_file:
+                the_file.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def run_main(self, *argv):
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            status = main(list(argv))
+            output, summary = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        records = [json.loads(line) for line in output.splitlines()]
+        return status, records, json.loads(summary)
+
+    def test_hash(self):
+        status, records, summary = self.run_main('-j', '2', 'hash', self.root)
+        self.assertEqual(status, 0)
+        self.assertEqual(len(records), 3)
+        for record in records:
+            self.assertEqual(record['md5'], Py7File(record['path']).get_md5())
+        self.assertEqual(summary['files'], 3)
+        self.assertEqual(summary['bytes'], 13)
+
+    def test_dedupe(self):
+        status, records, summary = self.run_main('dedupe', self.root)
+        self.assertEqual(len(records), 1)
+        self.assertEqual([os.path.basename(p) for p in records[0]['paths']],
+                         ['a.txt', 'b.txt'])
+
+    def test_backup_cleanup(self):
+        self.run_main('backup', self.root)
+        self.assertEqual(len(os.listdir(self.root)), 6)
+        status, records, summary = self.run_main('cleanup', self.root)
+        self.assertEqual(status, 0)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(len(os.listdir(self.root)), 3)
+
+    def test_rezip_skips_derived(self):
+        Py7File(os.path.join(self.root, 'a.txt')).backup()
+        archive = os.path.join(self.root, 'd.zip')
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.writestr('inner.zip', 'not really a zip')
+        Py7File(archive).unzip()
+        status, records, summary = self.run_main('rezip', self.root)
+        self.assertEqual(status, 0)
+        self.assertEqual([os.path.basename(r['path']) for r in records],
+                         ['d.zip'])
+
+    def test_undecodable_path(self):
+        path = os.path.join(self.root, b'\xff.txt')
+        with open(path, 'w') as the_file:
+            the_file.write('bytes')
+        status, records, summary = self.run_main('hash', path)
+        self.assertEqual(status, 0)
+        self.assertEqual(records[0]['md5'], Py7File(path).get_md5())
+        self.assertEqual(records[0]['path'],
+                         os.path.join(self.root, u'\ufffd.txt'))
+        self.assertEqual(records[0]['path_escaped'],
+                         os.path.join(self.root, '\\xff.txt'))
+
+    def test_derived_paths_given_explicitly(self):
+        book_unzipped = os.path.join(self.root, 'book_unzipped')
+        os.mkdir(book_unzipped)
+        for name in ('report_backup_2024.csv', 'member.txt'):
+            with open(os.path.join(book_unzipped, name), 'w') as the_file:
+                the_file.write('same')
+        status, records, summary = self.run_main(
+            'hash', os.path.join(book_unzipped, 'report_backup_2024.csv'))
+        self.assertEqual(len(records), 1)
+        status, records, summary = self.run_main('dedupe', book_unzipped)
+        self.assertEqual(len(records[0]['paths']), 2)
+        # read-only commands walk into derived files, backup does not
+        status, records, summary = self.run_main('hash', self.root)
+        self.assertEqual(len(records), 5)
+        status, records, summary = self.run_main('backup', self.root)
+        self.assertEqual(len(records), 3)
+
+    def test_error(self):
+        status, records, summary = self.run_main(
+            'hash', os.path.join(self.root, 'missing.txt'))
+        self.assertEqual(status, 1)
+        self.assertIn('error', records[0])
+        self.assertEqual(summary['errors'], 1)
 
 
 if __name__ == "__main__":